@@ -0,0 +1,67 @@
+# Compare rows/sec of the default to_sql upload with the bulk load path on a
+# local SQLite stand-in for the warehouse.
+#
+#   python -m benchmarks.bench_bulk_load --rows 200000 --batch-size 50000
+import argparse, os, tempfile, time
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+from utils.datasetup import bulk_insert, sql_types
+
+def fact_frame(rows, seed=0):
+    # Frame shaped like Total_Pay_Fact
+    rng = np.random.default_rng(seed)
+    hours = rng.integers(1, 8, rows)
+    distance = rng.integers(1, 40, rows)
+    hourly = rng.choice([70, 80, 100, 120], rows)
+    travel = np.round(distance * rng.choice([0.52, 0.72, 0.85], rows), 2)
+    weather = rng.choice([100, 120, 200], rows)
+    frame = pd.DataFrame({
+        'work hours': hours,
+        'travel distance': distance,
+        'job hourly': hourly,
+        'work payment $': hours * hourly,
+        'travel allowance amount': travel,
+        'weather allowance amount': weather,
+        'work payment': hours * hourly,
+        'total pay this job': hours * hourly + travel + weather,
+    })
+    for name, size in [('Staff', 3), ('Date', 4), ('MaintenanceJob', 4), ('Department', 2),
+                       ('TravelAllowancePolicy', 5), ('WeatherAllowancePolicy', 4), ('Holiday', 2)]:
+        frame[f'{name}_id'] = rng.integers(1, size + 1, rows)
+    frame['Total_Pay_Fact_id'] = np.arange(1, rows + 1)
+    return frame
+
+def time_upload(label, rows, upload):
+    start = time.perf_counter()
+    upload()
+    seconds = time.perf_counter() - start
+    print(f'{label:<12} {rows:>10} rows {seconds:8.2f} s {rows / seconds:12.0f} rows/sec')
+    return rows / seconds
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--batch-size', type=int, default=50000)
+    args = parser.parse_args()
+
+    frame = fact_frame(args.rows)
+    with tempfile.TemporaryDirectory() as folder:
+        engine = create_engine(f"sqlite:///{os.path.join(folder, 'bench.db')}")
+
+        def default_upload():
+            frame.to_sql('Total_Pay_Fact', engine, if_exists='replace', index=False)
+
+        def bulk_upload():
+            with engine.begin() as con:
+                frame.head(0).to_sql('Total_Pay_Fact', con, if_exists='replace', index=False, dtype=sql_types(frame))
+                bulk_insert(con, 'Total_Pay_Fact', frame, batch_size=args.batch_size)
+
+        default_rate = time_upload('to_sql', args.rows, default_upload)
+        bulk_rate = time_upload('bulk', args.rows, bulk_upload)
+        engine.dispose()
+    print(f'speed-up: {bulk_rate / default_rate:.2f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# End-to-end ETL benchmark on synthetic data against a local embedded warehouse.
+# Extract, every transform phase and the load of every table are timed by the
+# stage profiler; results are written per commit so runs can be compared.
+#
+#   python -m benchmarks.bench_etl --rows 1000000 --backend duckdb
+#   python -m benchmarks.bench_etl --rows 1000000 --compare benchmarks/results/<earlier run>.json
+import argparse, json, os, platform, subprocess, tempfile, time
+
+from benchmarks.synthetic import write_csv
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(ROOT, 'benchmarks', 'results')
+
+def git_commit():
+    # Short hash of the checked out commit, marked dirty when there are local changes
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    commit = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    return f'{commit}-dirty' if git('status', '--porcelain', '--untracked-files=no') else commit
+
+def configure(folder, backend):
+    # The ETL modules read their settings at import time
+    os.environ['STORAGE_BACKEND'] = 'local'
+    os.environ['LOCAL_STORAGE_PATH'] = os.path.join(folder, 'blobs')
+    os.environ['KEY_REGISTRY_PATH'] = os.path.join(folder, 'data', 'key_registry.db')
+    if backend == 'duckdb':
+        os.environ['WAREHOUSE_URL'] = f"duckdb:///{os.path.join(folder, 'warehouse.duckdb')}"
+    else:
+        os.environ['WAREHOUSE_URL'] = f"sqlite:///{os.path.join(folder, 'warehouse.db')}"
+
+def print_stages(result, baseline=None):
+    base = baseline['stages'] if baseline else {}
+    print(f"{'stage':<45} {'seconds':>9} {'rows/sec':>12}" + (f" {'baseline':>9} {'speed-up':>9}" if baseline else ''))
+    for name, stage in result['stages'].items():
+        rate = f"{stage['rows_per_sec']:12.0f}" if stage['rows_per_sec'] else f"{'':>12}"
+        line = f"{name:<45} {stage['seconds']:9.3f} {rate}"
+        if name in base:
+            line += f" {base[name]['seconds']:9.3f} {base[name]['seconds'] / max(stage['seconds'], 1e-9):8.2f}x"
+        print(line)
+    print(f"total {result['seconds']:.2f} s, {result['rows_per_sec']:.0f} rows/sec")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunksize', type=int, default=None, help='stream the source in batches of this many rows')
+    parser.add_argument('--out-of-core', action='store_true', help='two passes over the source, see MainETL.outOfCoreLoop')
+    parser.add_argument('--transform-workers', type=int, default=1, help='transform partitions of each batch on this many processes')
+    parser.add_argument('--backend', choices=['duckdb', 'sqlite'], default='duckdb')
+    parser.add_argument('--output', default=RESULTS)
+    parser.add_argument('--compare', default=None, help='results file of an earlier run')
+    args = parser.parse_args()
+    # Read the baseline first, this run may overwrite the same file
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+
+    with tempfile.TemporaryDirectory() as folder:
+        configure(folder, args.backend)
+        os.makedirs(os.path.join(folder, 'data'))
+        source = os.path.join(folder, 'blobs', 'example-data', 'ETL_Example_Data.csv')
+        write_csv(source, args.rows, seed=args.seed, sample_path=os.path.join(ROOT, 'data', 'ETL_Example_Data.csv'))
+
+        import pandas as pd
+        from main import MainETL
+        from utils.datasetup import get_engine
+        from utils.profiler import profiler
+
+        # Snapshots, calendar cache and registry go to the temporary folder
+        cwd = os.getcwd()
+        os.chdir(folder)
+        try:
+            profiler.clear()
+            start = time.perf_counter()
+            MainETL(transform_workers=args.transform_workers).mainLoop(chunksize=args.chunksize, out_of_core=args.out_of_core)
+            seconds = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+            get_engine().dispose()
+
+    result = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'rows': args.rows,
+        'seed': args.seed,
+        'chunksize': args.chunksize,
+        'transform_workers': args.transform_workers,
+        'out_of_core': args.out_of_core,
+        'backend': args.backend,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'seconds': seconds,
+        'rows_per_sec': args.rows / seconds,
+        'stages': profiler.summary(),
+    }
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"{result['commit']}-{args.backend}-{args.rows}{'-stream' if args.chunksize else ''}{'-ooc' if args.out_of_core else ''}{f'-w{args.transform_workers}' if args.transform_workers > 1 else ''}.json")
+    with open(path, 'w') as file:
+        json.dump(result, file, indent=2)
+
+    print_stages(result, baseline)
+    print(f'Results written to {path}')
+
+if __name__ == '__main__':
+    main()
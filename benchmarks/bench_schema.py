@@ -0,0 +1,37 @@
+# Compare memory and parse time of the source csv read with inferred types
+# against the declared schema in utils/schema.py.
+#
+#   python -m benchmarks.bench_schema --rows 1000000
+import argparse, io, time
+import numpy as np
+import pandas as pd
+
+from utils.schema import SOURCE_SCHEMA, memory_usage, format_bytes
+
+def source_csv(rows, path='./data/ETL_Example_Data.csv', seed=0):
+    # Sample rows of the example file until the csv has the requested size
+    sample = pd.read_csv(path, dtype=str)
+    rng = np.random.default_rng(seed)
+    frame = sample.iloc[rng.integers(0, len(sample), rows)]
+    return frame.to_csv(index=False).encode('utf-8')
+
+def time_read(label, data, **read_options):
+    start = time.perf_counter()
+    frame = pd.read_csv(io.BytesIO(data), **read_options)
+    seconds = time.perf_counter() - start
+    size = memory_usage(frame)
+    print(f'{label:<10} {len(frame):>10} rows {seconds:8.2f} s {format_bytes(size):>12} {size / len(frame):8.0f} bytes/row')
+    return size
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    data = source_csv(args.rows)
+    inferred = time_read('inferred', data)
+    typed = time_read('schema', data, **SOURCE_SCHEMA)
+    print(f'memory reduction: {inferred / typed:.2f}x')
+
+if __name__ == '__main__':
+    main()
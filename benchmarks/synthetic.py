@@ -0,0 +1,83 @@
+# Synthetic source data shaped like data/ETL_Example_Data.csv, at any size.
+# Policies, work types and weather come from the example file so the policy
+# dimensions keep their cardinality; staff, departments and dates scale.
+#
+#   python -m benchmarks.synthetic --rows 10000000 --output ./data/blobs/example-data/ETL_Example_Data.csv
+import argparse, os
+import numpy as np
+import pandas as pd
+
+SAMPLE_PATH = './data/ETL_Example_Data.csv'
+
+def staff_table(staff, departments, rng):
+    ids = np.arange(staff)
+    names = pd.Series(ids).map(lambda i: f'Staff {i:07d}')
+    return pd.DataFrame({
+        'Natural Key Staff ID': 10000000 + ids,
+        'Name': names,
+        'Contact Phone': pd.Series(ids).map(lambda i: f'04{i % 100:02d}-{(i // 100) % 1000:03d}-{i % 1000:03d}'),
+        'Home Address': pd.Series(ids).map(lambda i: f'{i % 500 + 1} Synthetic Street, Suburb {i % 97}'),
+        'Email': names.str.replace(' ', '.') + '@TelcoXYZ.com.au',
+        'Department': pd.Series(departments).iloc[rng.integers(0, len(departments), staff)].to_numpy(),
+    })
+
+def generate(rows, staff=None, departments=None, start='2021-01-01', end='2021-12-31', seed=0,
+             chunk_rows=1000000, sample_path=SAMPLE_PATH):
+    # Yield the rows in frames of at most chunk_rows, the same seed gives the same data
+    rng = np.random.default_rng(seed)
+    sample = pd.read_csv(sample_path)
+    staff = staff or max(len(sample['Natural Key Staff ID'].unique()), rows // 1000)
+    department_names = list(sample['Department'].unique())
+    if departments and departments > len(department_names):
+        department_names += [f'Depot {i}' for i in range(departments - len(department_names))]
+    people = staff_table(staff, department_names, rng)
+    travel = sample[['vehicle type', 'travelallowanceRate']].drop_duplicates().reset_index(drop=True)
+    weather = sample[['weather', 'temperature', 'weatehr allowance']].drop_duplicates().reset_index(drop=True)
+    work_types = sample['work type'].unique()
+    hourly = sample['job hourly'].unique()
+    days = pd.date_range(start, end, freq='D')
+    # Roughly one day in twenty is a holiday, the same days for every staff member
+    holidays = np.where(rng.random(len(days)) < 0.05, 'yes', 'no')
+
+    for offset in range(0, rows, chunk_rows):
+        size = min(chunk_rows, rows - offset)
+        frame = people.iloc[rng.integers(0, staff, size)].reset_index(drop=True)
+        day = rng.integers(0, len(days), size)
+        frame['date'] = days[day].strftime('%d/%m/%Y')
+        frame['work hours'] = rng.integers(1, 9, size)
+        frame['work type'] = work_types[rng.integers(0, len(work_types), size)]
+        frame['travel distance'] = rng.integers(1, 41, size)
+        policy = travel.iloc[rng.integers(0, len(travel), size)].reset_index(drop=True)
+        frame['vehicle type'] = policy['vehicle type']
+        conditions = weather.iloc[rng.integers(0, len(weather), size)].reset_index(drop=True)
+        frame['weather'] = conditions['weather']
+        frame['temperature'] = conditions['temperature']
+        frame['isholiday'] = holidays[day]
+        frame['job hourly'] = hourly[rng.integers(0, len(hourly), size)]
+        frame['work payment $'] = frame['work hours'] * frame['job hourly']
+        frame['travelallowanceRate'] = policy['travelallowanceRate']
+        frame['weatehr allowance'] = conditions['weatehr allowance']
+        yield frame[sample.columns]
+
+def write_csv(path, rows, **options):
+    # Write the synthetic source csv chunk by chunk
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    for i, frame in enumerate(generate(rows, **options)):
+        frame.to_csv(path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+    return path
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--staff', type=int, default=None)
+    parser.add_argument('--departments', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='./data/blobs/example-data/ETL_Example_Data.csv')
+    args = parser.parse_args()
+    write_csv(args.output, args.rows, staff=args.staff, departments=args.departments, seed=args.seed)
+    print(f'Wrote {args.rows} rows to {args.output}')
+
+if __name__ == '__main__':
+    main()
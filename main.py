@@ -1,146 +1,603 @@
-import os, uuid
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
-from dotenv import load_dotenv
+import os, time
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from utils.datasetup import *
 from utils.dimension_classes import *
+from utils.key_registry import KeyRegistry
+from utils.artifacts import write_snapshot, snapshot_path, read_snapshot_parts
+from utils.allowance import AllowanceRules
+from utils.profiler import profiler, profile_path
+from utils.checkpoint import RunCheckpoint, run_path
+from utils.parallel_transform import POLICY_DIMENSIONS, transform_keys, transform_partitions, transform_pool, same_shared
+from utils.schema import SOURCE_SCHEMA, SOURCE_KEY_COLUMNS, apply_schema, row_hash, memory_usage, format_bytes
+
+# Fact measures kept in the summary tables, with the names the API returns
+PAY_MEASURES = {
+    'work payment': 'Hourly_Pay',
+    'travel allowance amount': 'Travel_Pay',
+    'weather allowance amount': 'Weather_Pay',
+    'total pay this job': 'Total_Pay',
+    'work hours': 'Total_Hours',
+}
 
 class MainETL():
     # List of columns need to be replaced
-    def __init__(self) -> None:
+    def __init__(self, parallel_load=False, load_workers=4, extract_workers=4, rules=None,
+                 transform_workers=1, partition_column='Natural Key Staff ID') -> None:
         self.drop_columns = []
         self.dimension_tables = []
-        
-    def extract(self, csv_file="ETL_Example_Data.csv"):
+        self.fact_table = None
+        self.batches = None
+        self.fact_rows = 0
+        self.registry = None
+        self.pay_summary = None
+        # Upload dimension tables concurrently on a bounded thread pool
+        self.parallel_load = parallel_load
+        self.load_workers = load_workers
+        self.load_timings = {}
+        # Download and parse source blobs concurrently when extracting a blob pattern
+        self.extract_workers = extract_workers
+        self.extract_timings = {}
+        # Transform partitions of every batch on this many processes, rows with the same
+        # partition column value go to the same partition
+        self.transform_workers = transform_workers
+        self.partition_column = partition_column
+        # Process pool of the run and the dimension indexes its workers were started with
+        self.pool = None
+        self.pool_shared = None
+        # Travel, weather and holiday pay rules, from ALLOWANCE_RULES_PATH by default
+        self.rules = rules if rules is not None else AllowanceRules.from_file()
+        # Occurrences of every source key hash seen so far, for change data capture
+        self.key_counts = pd.Series(dtype='int64')
+
+    def extract(self, csv_file="ETL_Example_Data.csv", chunksize=None, pattern=None):
         # Step 1: Extract: use pandas read_csv to open the csv file and extract data
         print(f'Step 1: Extracting data from csv file')
-        self.fact_table = df
-        print(f'We find {len(self.fact_table.index)} rows and {len(self.fact_table.columns)} columns in csv file: {csv_file}')
+        if pattern:
+            # Multi-blob mode: every blob matching the prefix or glob pattern is one batch.
+            # Blobs are listed here, so a pattern matching nothing fails before any table is dropped
+            self.batches = self.extract_blobs(self.source_blobs(pattern), pattern)
+            if not chunksize:
+                with profiler.stage('extract') as stage:
+                    self.fact_table = pd.concat(list(self.batches), ignore_index=True)
+                    stage['frame'] = self.fact_table
+                self.batches = None
+                print(f'We find {len(self.fact_table.index)} rows and {len(self.fact_table.columns)} columns in blobs: {pattern}')
+                print(f'Typed source frame uses {format_bytes(memory_usage(self.fact_table))}')
+        elif chunksize:
+            # Streaming mode: batches are read lazily from the blob download stream
+            self.batches = database.stream_blob_csv(blob_name=csv_file, chunksize=chunksize, **SOURCE_SCHEMA)
+            print(f'Streaming csv file: {csv_file} in batches of {chunksize} rows')
+        else:
+            self.fact_table = database.access_blob_csv(blob_name=csv_file, **SOURCE_SCHEMA)
+            print(f'We find {len(self.fact_table.index)} rows and {len(self.fact_table.columns)} columns in csv file: {csv_file}')
+            print(f'Typed source frame uses {format_bytes(memory_usage(self.fact_table))}')
         print(f'Step 1 finished')
-        
-    def transform(self):
-        # transform data types
-        self.fact_table[['travelallowanceRate']] = self.fact_table[['travelallowanceRate']].astype(float)
-        int_cols = ['travel distance', 'weatehr allowance', 'work hours', 'job hourly']
-        self.fact_table[int_cols] = self.fact_table[int_cols].astype(int)
-        self.fact_table[['weather', 'temperature']] = self.fact_table[['weather', 'temperature']].astype(str)
-        
-        # fetch staff dimension table
-        dim_staff = DimStaff()
-        self.drop_columns += dim_staff.columns
-        self.dimension_tables.append(dim_staff)
-             
-        # fetch date dimension table
-        dim_date = DimDate()
-        self.drop_columns += dim_date.columns
-        new_dim =  dim_date.dimension_table[['date']]
-        # Convert the date column to datetime format
-        new_dim['date'] = pd.to_datetime(new_dim['date'], format='%d/%m/%Y')
-        self.fact_table['date'] = pd.to_datetime(self.fact_table['date'], format='%d/%m/%Y')
-        # Extract the month number and convert it to month name
-        new_dim['date'] = new_dim['date'].dt.month_name()
-        self.fact_table['date'] = self.fact_table['date'].dt.month_name()
-        new_dim = new_dim.drop_duplicates()
-        # Modify primary key for date dimension table
-        new_dim[f'Date_id'] = range(1, len(new_dim) + 1)
-        dim_date.dimension_table = new_dim
-        self.dimension_tables.append(dim_date)
-        
-        # fetch maintenance job dimension table
-        dim_job = DimMaintenanceJob()
-        self.drop_columns += dim_job.columns
-        self.dimension_tables.append(dim_job)
-        
-        # fetch department dimension table
-        dim_department = DimDepartment()
-        self.drop_columns += dim_department.columns
-        self.dimension_tables.append(dim_department)
-        
-        # fetch travel dimension table
-        dim_travel_allowance = DimTravelAllowancePolicy()
-        self.drop_columns += dim_travel_allowance.columns
-        self.dimension_tables.append(dim_travel_allowance)
-        
-        # fetch weather dimension table
-        dim_weather_allowance = DimWeatherAllowancePolicy()
-        self.drop_columns += dim_weather_allowance.columns
-        
-        new_weather = dim_weather_allowance.dimension_table[['weather', 'temperature', 'weatehr allowance']]
-        new_weather.loc[new_weather['weather'] == "heavy rain", 'weather'] = "rain"
-        self.fact_table.loc[self.fact_table['weather'] == "heavy rain", 'weather'] = "rain"
-        
-        new_weather = new_weather.drop_duplicates()
-        
-        # Create new foreign key column
-        new_weather['WeatherAllowancePolicy_id'] = range(1, len(new_weather) + 1)
-        dim_weather_allowance.dimension_table = new_weather
-        self.dimension_tables.append(dim_weather_allowance)
-        
-        # fetch holiday dimension table
-        dim_holiday = ModelAbstract()
-        dim_holiday.dimension_generator('Holiday', ['isholiday'])
-        self.drop_columns += dim_holiday.columns
-        self.dimension_tables.append(dim_holiday)
-        
-        # Get Travel Allowance amount
-        travel_allowance_amount = self.fact_table['travel distance'] * self.fact_table['travelallowanceRate']
-        self.fact_table['travel allowance amount'] = travel_allowance_amount
-        
-        # Get Weather Allowance Amount
-        weather_allowance_amount = self.fact_table['weatehr allowance']
-        self.fact_table['weather allowance amount'] = weather_allowance_amount 
-        
-        # Get Hourly Work Payment
-        work_payment = self.fact_table['work hours'] * self.fact_table['job hourly']
-        self.fact_table['work payment'] = work_payment
-        
-        # Get Total Payment
-        self.fact_table['total pay this job'] = work_payment + travel_allowance_amount + weather_allowance_amount
-        
-        # Replace columns in fact table with respective foreign keys
+
+    def source_blobs(self, pattern):
+        # Names of the blobs matching pattern, at least one
+        blob_names = database.find_blobs(pattern)
+        if not blob_names:
+            raise FileNotFoundError(f'No blobs in container {database.container_name} match {pattern}')
+        return blob_names
+
+    def extract_blobs(self, blob_names, pattern):
+        # Yield the DataFrame of each of blob_names, the blobs matching pattern. Up to
+        # extract_workers blobs are downloaded and parsed at once; a new download only
+        # starts when the consumer takes a frame, so memory stays bounded while batches
+        # are streamed into transform.
+        print(f'Extracting {len(blob_names)} blobs matching {pattern} on {self.extract_workers} threads')
+
+        def read_blob(blob_name):
+            start = time.perf_counter()
+            frame, size = database.read_blob_csv(blob_name, **SOURCE_SCHEMA)
+            return frame, size, time.perf_counter() - start
+
+        start = time.perf_counter()
+        total_rows = total_bytes = 0
+        with ThreadPoolExecutor(max_workers=self.extract_workers) as pool:
+            names = iter(blob_names)
+            pending = deque()
+
+            def submit_next():
+                blob_name = next(names, None)
+                if blob_name is not None:
+                    pending.append((blob_name, pool.submit(read_blob, blob_name)))
+
+            for _ in range(self.extract_workers):
+                submit_next()
+            done = 0
+            while pending:
+                blob_name, future = pending.popleft()
+                frame, size, seconds = future.result()
+                submit_next()
+                done += 1
+                total_rows += len(frame)
+                total_bytes += size
+                self.extract_timings[blob_name] = seconds
+                print(f'[{done}/{len(blob_names)}] {blob_name}: {len(frame)} rows, {size / 1e6:.2f} MB in {seconds:.2f} s '
+                      f'({len(frame) / max(seconds, 1e-9):.0f} rows/sec, {size / 1e6 / max(seconds, 1e-9):.2f} MB/s)')
+                yield frame
+        seconds = time.perf_counter() - start
+        print(f'Extracted {total_rows} rows, {total_bytes / 1e6:.2f} MB from {len(blob_names)} blobs in {seconds:.2f} s '
+              f'({total_rows / max(seconds, 1e-9):.0f} rows/sec)')
+
+    def create_dimensions(self):
+        # Dimension tables start empty and grow with every transformed batch
+        self.dimension_tables = [
+            DimStaff(),
+            DimDate(),
+            DimMaintenanceJob(),
+            DimDepartment(),
+            DimTravelAllowancePolicy(),
+            DimWeatherAllowancePolicy(),
+            DimHoliday(),
+        ]
         for dim in self.dimension_tables:
-            self.fact_table = pd.merge(self.fact_table, dim.dimension_table, on=dim.columns, how='left')
-        self.fact_table = self.fact_table.drop(columns=self.drop_columns)
-        
+            dim.registry = self.registry
+            self.drop_columns += dim.columns
+
+    def transform(self, batch=None, update=True):
+        # update=False resolves keys against the dimensions as they are, every key must be in them
+        fact_table = self.fact_table if batch is None else batch
+        start = time.perf_counter()
+
+        # transform data types, a no-op for frames extracted with SOURCE_SCHEMA
+        with profiler.stage('transform/schema', rows=len(fact_table)):
+            fact_table = apply_schema(fact_table)
+            source_memory = memory_usage(fact_table)
+
+            # Weather aliases such as heavy rain share one weather allowance policy
+            fact_table = self.rules.normalize(fact_table)
+
+        # fetch staff, date, maintenance job, department, travel, weather and holiday dimension tables
+        if not self.dimension_tables:
+            self.create_dimensions()
+        if update:
+            self.update_dimensions(fact_table)
+
+        # Allowances, foreign keys and pay sums against read-only indexes of the dimensions
+        shared = {
+            'indexes': {dim.name: dim.key_index() for dim in self.dimension_tables},
+            'policies': {name: self.dimension(name).dimension_table for name in POLICY_DIMENSIONS},
+            'rules': self.rules,
+            'drop_columns': self.drop_columns,
+            'measures': list(PAY_MEASURES),
+        }
+        # Empty batches, e.g. a header-only blob, have no partition and are transformed here
+        if self.transform_workers > 1 and len(fact_table):
+            with profiler.stage('transform/partitions', rows=len(fact_table)):
+                fact_table, sums = transform_partitions(fact_table, self.partition_column, self.partition_pool(shared), self.transform_workers)
+        else:
+            fact_table, sums = transform_keys(fact_table, stage=profiler.stage, **shared)
+
+        # Creating primary key for fact table, continuing from the previous batch
+        fact_table['Total_Pay_Fact_id'] = range(self.fact_rows + 1, self.fact_rows + len(fact_table) + 1)
+        self.fact_rows += len(fact_table)
+        self.fact_table = fact_table
+        self.summarize(sums)
+        profiler.record('transform', time.perf_counter() - start, frame=fact_table)
+
+        print(f'Fact frame memory: {format_bytes(source_memory)} typed source, {format_bytes(memory_usage(fact_table))} after transform')
         print(f'Step 2 finished')
-        
-    def load(self):
-        for table in self.dimension_tables:
-            table.load()
-        with engine.connect() as con:
-            trans = con.begin()
-            self.fact_table['Total_Pay_Fact_id'] = range(1, len(self.fact_table) + 1)
-            database.upload_dataframe_sqldatabase(f'Total_Pay_Fact', blob_data=self.fact_table)
-            
-            # self.fact_table['Total_Pay_Fact_id'] = range(len(self.fact_table) + 2, 2*(len(self.fact_table) + 1))
-            # database.append_dataframe_sqldatabase(f'Total_Pay_Fact', blob_data=self.fact_table)
-            self.fact_table.to_csv('./data/Total_Pay_Fact.csv')
 
+    def partition_pool(self, shared):
+        # One pool serves every batch of the run; it is only restarted when a batch changed
+        # a dimension index or policy table, as workers hold the ones they were started with
+        if self.pool is not None and not same_shared(shared, self.pool_shared):
+            self.close_pool()
+        if self.pool is None:
+            self.pool = transform_pool(self.transform_workers, shared)
+            self.pool_shared = shared
+        return self.pool
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+            self.pool_shared = None
+
+    def update_dimensions(self, fact_table):
+        for dim in self.dimension_tables:
+            # Merge of the batch keys into the dimension
+            with profiler.stage(f'transform/{dim.name}_dim', rows=len(fact_table)):
+                dim.update(fact_table)
+
+    def dimension(self, name):
+        return next(dim for dim in self.dimension_tables if dim.name == name)
+
+    def summarize(self, sums):
+        # Running pay sums per staff and date, so summary tables need no extra pass over the facts
+        if self.pay_summary is not None:
+            sums = pd.concat([self.pay_summary, sums]).groupby(['Staff_id', 'Date_id'], as_index=False).sum()
+        self.pay_summary = sums
+
+    def load_summaries(self, incremental=False):
+        # Pre-aggregated tables the API reads instead of scanning the fact table
+        pay = self.pay_summary.rename(columns=PAY_MEASURES)
+        measures = list(PAY_MEASURES.values())
+        dates = self.dimension('Date').dimension_table[['Date_id', 'Year', 'Month', 'date']]
+        staff = self.dimension('Staff').dimension_table[['Staff_id', 'Name']]
+        summaries = {
+            # Keyed by year and month, the month name alone would merge the same month of every year
+            'Staff_Month_Pay_Agg': (pay.merge(dates, on='Date_id'), ['Staff_id', 'Year', 'Month', 'date']),
+            'Staff_Pay_Agg': (pay.merge(staff, on='Staff_id'), ['Staff_id', 'Name']),
+        }
+        for table_name, (summary, keys) in summaries.items():
+            if incremental and database.table_exists(table_name):
+                # Add this run's sums to the ones already in the warehouse
+                loaded = pd.DataFrame(database.get_sql_table(f'SELECT * FROM [dbo].[{table_name}]'))
+                summary = pd.concat([loaded, summary])
+            summary = summary.groupby(keys, as_index=False)[measures].sum()
+            database.upload_dataframe_sqldatabase(table_name, blob_data=summary, primary_key=False)
+
+    def load_dimensions(self, incremental=False, run=None):
+        # Tables a resumed run already loaded are skipped
+        tables = [table for table in self.dimension_tables if run is None or not run.done(f'load/{table.name}_dim')]
+        registry = self.registry or KeyRegistry()
+
+        def load_table(table):
+            start = time.perf_counter()
+            if incremental:
+                table.append()
+            else:
+                # A full load numbers members from 1, later incremental runs must hand out the same ids
+                table.load()
+                table.reseed(registry)
+            if run is not None:
+                run.complete(f'load/{table.name}_dim')
+            return time.perf_counter() - start
+
+        if self.parallel_load:
+            # Dimension tables are independent, each worker uses its own pooled connection.
+            # Leaving the with block waits for every upload, so a failure re-raised below
+            # happens before the fact upload starts; each failed table rolls back on its own.
+            with ThreadPoolExecutor(max_workers=self.load_workers) as pool:
+                futures = [(table, pool.submit(load_table, table)) for table in tables]
+            timings = [(table, future.result()) for table, future in futures]
+        else:
+            timings = [(table, load_table(table)) for table in tables]
+
+        for table, seconds in timings:
+            self.load_timings[f'{table.name}_dim'] = seconds
+            print(f'{table.name}_dim loaded in {seconds:.2f} s')
+
+    def load_fact(self, append=False, foreign_keys=True):
+        if append:
+            database.append_dataframe_sqldatabase(f'Total_Pay_Fact', blob_data=self.fact_table)
+            write_snapshot('Total_Pay_Fact', self.fact_table, append=True)
+        else:
+            database.upload_dataframe_sqldatabase(f'Total_Pay_Fact', blob_data=self.fact_table, foreign_keys=self.foreign_keys() if foreign_keys else None)
+            write_snapshot('Total_Pay_Fact', self.fact_table)
+
+    def foreign_keys(self):
+        # Foreign keys declared when an embedded backend creates the fact table
+        if is_mssql():
+            return None
+        return {f'{table.name}_id': f'{table.name}_dim' for table in self.dimension_tables if database.table_exists(f'{table.name}_dim')}
+
+    def add_foreign_keys(self):
+        if not is_mssql():
+            return
+        with profiler.stage('load/Total_Pay_Fact/foreign_keys'), get_engine().connect() as con:
+            trans = con.begin()
             for table in self.dimension_tables:
                 con.execute(text(f'ALTER TABLE [dbo].[Total_Pay_Fact] WITH NOCHECK ADD CONSTRAINT [FK_{table.name}_dim] FOREIGN KEY ([{table.name}_id]) REFERENCES [dbo].[{table.name}_dim] ([{table.name}_id]) ON UPDATE CASCADE ON DELETE CASCADE;'))
             trans.commit()
-            
+
+    def add_indexes(self):
+        # Date range filters on the fact table seek this index instead of scanning
+        with profiler.stage('load/Total_Pay_Fact/indexes'), get_engine().begin() as con:
+            con.execute(sql('CREATE INDEX [IX_Total_Pay_Fact_Date_id] ON [dbo].[Total_Pay_Fact] ([Date_id])'))
+
+    def load(self, run=None):
+        # With a RunCheckpoint every table and step is recorded once done and skipped when resuming
+        with profiler.stage('load', rows=len(self.fact_table)):
+            self.load_dimensions(run=run)
+            self.checkpointed(run, 'load/Total_Pay_Fact', self.load_fact)
+            self.finish_load(run=run)
+
+    def finish_load(self, create=True, incremental=False, run=None):
+        # Closing steps shared by every load mode: keys and indexes of a newly created fact
+        # table, the summary tables, then the ETL version stamp that invalidates the API result caches
+        if create:
+            self.checkpointed(run, 'load/foreign_keys', self.add_foreign_keys)
+            self.checkpointed(run, 'load/indexes', self.add_indexes)
+        self.checkpointed(run, 'load/summaries', lambda: self.load_summaries(incremental=incremental))
+        self.checkpointed(run, 'load/ETL_Version', database.write_etl_version)
+
         print(f'Step 3 finished')
-        
-    def mainLoop(self):    
-        # Step 1
-        self.extract()
-        # Step 2
-        self.transform()
+
+    def checkpointed(self, run, step, function):
+        if run is not None and run.done(step):
+            print(f'{step} done in an earlier attempt, skipped')
+            return
+        function()
+        if run is not None:
+            run.complete(step)
+
+    def resumableLoop(self, run_path, pattern=None):
+        # Full load that checkpoints the extracted frame, the transformed tables and every
+        # loaded table in run_path. A rerun after a failure resumes after the last completed
+        # step or table; the checkpoints are removed once the run succeeds.
+        run = RunCheckpoint(run_path, settings={'pattern': pattern, 'rules': vars(self.rules)})
+        if run.done('transform'):
+            self.restore_transform(run)
+        else:
+            if run.done('extract'):
+                self.fact_table = run.read_frame('extract')
+            else:
+                # Step 1
+                self.extract(pattern=pattern)
+                run.write_frame('extract', self.fact_table)
+                run.complete('extract')
+            # Step 2
+            self.transform()
+            self.checkpoint_transform(run)
         # Step 3
+        if not run.done('load/Total_Pay_Fact') and database.table_exists('Total_Pay_Fact'):
+            database.delete_sqldatabase('Total_Pay_Fact')
+        self.load(run)
+        run.clear()
+
+    def checkpoint_transform(self, run):
+        # Everything the load step reads
+        run.write_frame('Total_Pay_Fact', self.fact_table)
+        run.write_frame('pay_summary', self.pay_summary)
+        for dim in self.dimension_tables:
+            run.write_frame(f'{dim.name}_dim', dim.dimension_table)
+        run.complete('transform')
+
+    def restore_transform(self, run):
+        self.create_dimensions()
+        for dim in self.dimension_tables:
+            dim.dimension_table = run.read_frame(f'{dim.name}_dim')
+        self.fact_table = run.read_frame('Total_Pay_Fact')
+        self.pay_summary = run.read_frame('pay_summary')
+
+    def streamLoop(self):
+        # Step 2 and 3 run once per batch, so only one batch is held in memory
         try:
             database.delete_sqldatabase('Total_Pay_Fact')
+        except Exception as ex:
+            print(f'Table Total_Pay_Fact not dropped: {ex}')
+        for i, batch in enumerate(self.batches):
+            self.transform(batch)
+            # Dimension tables are replaced after the last batch, so embedded
+            # backends cannot declare foreign keys to them here
+            self.load_fact(append=i > 0, foreign_keys=False)
+        # Dimension tables are complete only after the last batch
+        self.load_dimensions()
+        self.finish_load()
+
+    def source_batches(self, chunksize, pattern=None, csv_file="ETL_Example_Data.csv", **read_options):
+        # A new stream of source batches of at most chunksize rows, each call reads the source
+        # again from the start; blobs matching pattern are streamed one after the other
+        read_options = {**SOURCE_SCHEMA, **read_options}
+        blob_names = self.source_blobs(pattern) if pattern else [csv_file]
+        for blob_name in blob_names:
+            yield from database.stream_blob_csv(blob_name=blob_name, chunksize=chunksize, **read_options)
+
+    def outOfCoreLoop(self, chunksize, pattern=None, spill_path=None):
+        # Two passes over the source for inputs larger than memory. The first reads only the
+        # dimension columns and builds every dimension one batch at a time, so memory holds a
+        # batch and the distinct keys seen so far. The second resolves the keys of each fact
+        # batch against the finished dimensions and writes it out before reading the next:
+        # appended to Total_Pay_Fact, or spilled as Parquet parts to spill_path and loaded
+        # into the warehouse part by part afterwards.
+        if not self.dimension_tables:
+            self.create_dimensions()
+        print(f'Pass 1: building dimensions from batches of {chunksize} rows')
+        columns = list(dict.fromkeys(self.drop_columns))
+        for batch in self.source_batches(chunksize, pattern, usecols=columns):
+            with profiler.stage('transform/schema', rows=len(batch)):
+                batch = self.rules.normalize(apply_schema(batch))
+            self.update_dimensions(batch)
+        # Dimensions are final, so the fact table can declare foreign keys to them. The old
+        # fact table goes first, embedded backends refuse to drop tables it references.
+        if database.table_exists('Total_Pay_Fact'):
+            database.delete_sqldatabase('Total_Pay_Fact')
+        self.load_dimensions()
+
+        print(f'Pass 2: resolving fact keys')
+        parts = 0
+        for batch in self.source_batches(chunksize, pattern):
+            self.transform(batch, update=False)
+            if spill_path:
+                with profiler.stage('spill/Total_Pay_Fact', frame=self.fact_table):
+                    write_snapshot('Total_Pay_Fact', self.fact_table, append=parts > 0, fmt='parquet', folder=spill_path)
+            else:
+                self.load_fact(append=parts > 0)
+            parts += 1
+            self.fact_table = None
+        if spill_path:
+            self.load_spilled_facts(spill_path)
+        self.finish_load()
+
+    def load_spilled_facts(self, spill_path):
+        # Upload the spilled fact parts one at a time, only one part is held in memory
+        folder = snapshot_path('Total_Pay_Fact', 'parquet', spill_path)
+        for i, part in enumerate(read_snapshot_parts('Total_Pay_Fact', spill_path)):
+            self.fact_table = part
+            if i == 0:
+                database.upload_dataframe_sqldatabase('Total_Pay_Fact', blob_data=self.fact_table, foreign_keys=self.foreign_keys())
+            else:
+                database.append_dataframe_sqldatabase('Total_Pay_Fact', blob_data=self.fact_table)
+        self.fact_table = None
+        print(f'Loaded Total_Pay_Fact from {folder}')
+
+    def incrementalLoop(self):
+        # Every extracted row is appended as a new fact, so the source must hold only rows
+        # not loaded yet; cdcLoop handles sources that are resent in full. Dimension ids
+        # come from the key registry.
+        create = not database.table_exists('Total_Pay_Fact')
+        self.fact_rows = 0 if create else database.get_max_id('Total_Pay_Fact', 'Total_Pay_Fact_id')
+        batches = self.batches if self.batches is not None else [self.fact_table]
+        for i, batch in enumerate(batches):
+            self.transform(batch)
+            # New dimension rows must exist before the facts referencing them
+            self.load_dimensions(incremental=True)
+            self.load_fact(append=not create or i > 0)
+        self.finish_load(create=create, incremental=not create)
+
+    def row_keys(self, batch):
+        # Hash of the source key and of how often the key was seen before in this load,
+        # so repeated jobs of a staff member on one day keep distinct row keys
+        base = pd.Series(row_hash(batch, SOURCE_KEY_COLUMNS))
+        occurrence = base.groupby(base.to_numpy()).cumcount().to_numpy() + self.key_counts.reindex(base.to_numpy(), fill_value=0).to_numpy()
+        self.key_counts = self.key_counts.add(base.value_counts(), fill_value=0).astype('int64')
+        return row_hash(pd.DataFrame({'key': base.to_numpy(), 'occurrence': occurrence}))
+
+    def cdcLoop(self):
+        # Change data capture: every source row is hashed and compared with the hashes
+        # stored with the loaded facts; only new, changed and deleted facts are written,
+        # through staging tables merged into Total_Pay_Fact
+        columns = database.table_columns('Total_Pay_Fact') if database.table_exists('Total_Pay_Fact') else []
+        create = 'Row_Key' not in columns
+        state = pd.DataFrame(columns=['Row_Key', 'Row_Hash', 'Total_Pay_Fact_id'], dtype='int64')
+        if create and columns:
+            # Facts loaded without row hashes cannot be compared, reload them once
+            database.delete_sqldatabase('Total_Pay_Fact')
+        elif not create:
+            state = pd.DataFrame(database.get_sql_table('SELECT [Row_Key], [Row_Hash], [Total_Pay_Fact_id] FROM [dbo].[Total_Pay_Fact]'), columns=state.columns)
+        state_index = pd.Index(state['Row_Key'].to_numpy(dtype='int64'))
+        state_hashes = state['Row_Hash'].to_numpy(dtype='int64')
+        state_ids = state['Total_Pay_Fact_id'].to_numpy(dtype='int64')
+        self.fact_rows = int(state_ids.max()) if len(state_ids) else 0
+        self.key_counts = pd.Series(dtype='int64')
+
+        seen = []
+        changes = {'new': 0, 'changed': 0, 'deleted': 0}
+        staging_tables = set()
+        batches = self.batches if self.batches is not None else [self.fact_table]
+        for batch in batches:
+            batch = apply_schema(batch)
+            hashes = row_hash(batch)
+            batch['Row_Key'] = self.row_keys(batch)
+            batch['Row_Hash'] = hashes
+            seen.append(batch['Row_Key'].to_numpy())
+
+            positions = state_index.get_indexer(batch['Row_Key'])
+            new = positions < 0
+            changed = ~new
+            changed[changed] = state_hashes[positions[changed]] != hashes[changed]
+            keep = new | changed
+            changes['new'] += int(new.sum())
+            changes['changed'] += int(changed.sum())
+            if not keep.any():
+                continue
+
+            # Changed facts keep their id, new facts continue from the highest one
+            start = self.fact_rows
+            self.transform(batch[keep])
+            is_new = new[keep]
+            ids = np.empty(int(keep.sum()), dtype='int64')
+            ids[is_new] = np.arange(start + 1, start + int(is_new.sum()) + 1)
+            ids[~is_new] = state_ids[positions[keep][~is_new]]
+            self.fact_table['Total_Pay_Fact_id'] = ids
+            self.fact_rows = start + int(is_new.sum())
+
+            # New dimension rows must exist before the facts referencing them
+            self.load_dimensions(incremental=True)
+            if create:
+                self.load_fact(append=start > 0)
+            else:
+                fact_columns = list(self.fact_table.columns)
+                database.upload_dataframe_sqldatabase('Total_Pay_Fact_Stage', blob_data=self.fact_table, primary_key=False)
+                database.merge_sqldatabase('Total_Pay_Fact', 'Row_Key', fact_columns, stage_name='Total_Pay_Fact_Stage',
+                                           update_columns=[column for column in fact_columns if column not in ('Row_Key', 'Total_Pay_Fact_id')])
+                staging_tables.add('Total_Pay_Fact_Stage')
+
+        # Facts whose source rows are gone
+        seen = np.concatenate(seen) if seen else np.empty(0, dtype='int64')
+        deleted = state.loc[~state['Row_Key'].isin(seen), ['Row_Key']]
+        changes['deleted'] = len(deleted)
+        if len(deleted):
+            database.upload_dataframe_sqldatabase('Total_Pay_Fact_Deleted', blob_data=deleted, primary_key=False)
+            database.merge_sqldatabase('Total_Pay_Fact', 'Row_Key', [], deleted_name='Total_Pay_Fact_Deleted')
+            staging_tables.add('Total_Pay_Fact_Deleted')
+        for table_name in staging_tables:
+            database.delete_sqldatabase(table_name)
+        print(f"Changes: {changes['new']} new, {changes['changed']} changed, {changes['deleted']} deleted facts")
+        if not any(changes.values()):
+            print(f'Step 3 finished')
+            return
+
+        # Summaries are rebuilt from the merged facts, changed and deleted facts cannot be added up
+        if not self.dimension_tables:
+            self.create_dimensions()
+        for dim in self.dimension_tables:
+            dim.restore()
+        measures = ', '.join(f'SUM([{measure}]) AS [{measure}]' for measure in PAY_MEASURES)
+        self.pay_summary = pd.DataFrame(database.get_sql_table(f'SELECT [Staff_id], [Date_id], {measures} FROM [dbo].[Total_Pay_Fact] GROUP BY [Staff_id], [Date_id]'),
+                                        columns=['Staff_id', 'Date_id', *PAY_MEASURES])
+        self.finish_load(create=create)
+
+    def mainLoop(self, chunksize=None, incremental=False, pattern=None, cdc=False, out_of_core=False, spill_path=None, run_path=None):
+        try:
+            if out_of_core:
+                # Extract, transform and load are interleaved over two passes of the source
+                self.outOfCoreLoop(chunksize or 1000000, pattern=pattern, spill_path=spill_path)
+                return
+            if run_path and not (chunksize or incremental or cdc):
+                self.resumableLoop(run_path, pattern=pattern)
+                return
+            # Step 1
+            self.extract(chunksize=chunksize, pattern=pattern)
+            if incremental or cdc:
+                self.registry = KeyRegistry()
+                if cdc:
+                    self.cdcLoop()
+                else:
+                    self.incrementalLoop()
+                return
+            if chunksize:
+                self.streamLoop()
+                return
+            # Step 2
+            self.transform()
+            # Step 3
+            if database.table_exists('Total_Pay_Fact'):
+                database.delete_sqldatabase('Total_Pay_Fact')
             self.load()
-        except:
-            self.load()
-        
+        finally:
+            # The transform processes live for the run only
+            self.close_pool()
+
 def main():
     # create an instance of MainETL
-    main = MainETL()
-    main.mainLoop()
-    
+    # Set ETL_PARALLEL_LOAD=1 to upload dimension tables on ETL_LOAD_WORKERS threads
+    # Set ETL_EXTRACT_WORKERS to download that many source blobs at once
+    # Set ETL_TRANSFORM_WORKERS to transform partitions of each batch on that many processes,
+    # split by ETL_PARTITION_COLUMN (Natural Key Staff ID or Department)
+    main = MainETL(parallel_load=os.environ.get('ETL_PARALLEL_LOAD', '0') == '1', load_workers=int(os.environ.get('ETL_LOAD_WORKERS', 4)),
+                   extract_workers=int(os.environ.get('ETL_EXTRACT_WORKERS', 4)),
+                   transform_workers=int(os.environ.get('ETL_TRANSFORM_WORKERS', 1)),
+                   partition_column=os.environ.get('ETL_PARTITION_COLUMN', 'Natural Key Staff ID'))
+    # Set ETL_CHUNK_SIZE to stream the source csv in batches of that many rows
+    chunksize = int(os.environ.get('ETL_CHUNK_SIZE', 0)) or None
+    # Set ETL_INCREMENTAL=1 to append the extracted rows instead of reloading the warehouse,
+    # for sources holding only rows not loaded yet
+    incremental = os.environ.get('ETL_INCREMENTAL', '0') == '1'
+    # Set ETL_SOURCE_PATTERN to extract every blob matching a prefix or glob, e.g. 'depot-*/*.csv'
+    pattern = os.environ.get('ETL_SOURCE_PATTERN') or None
+    # Set ETL_CDC=1 to merge only new, changed and deleted facts into the warehouse
+    cdc = os.environ.get('ETL_CDC', '0') == '1'
+    # Set ETL_OUT_OF_CORE=1 for sources larger than memory: dimensions are built in a first pass over
+    # the source and facts resolved in a second, both in ETL_CHUNK_SIZE batches (1000000 by default)
+    out_of_core = os.environ.get('ETL_OUT_OF_CORE', '0') == '1'
+    # Set ETL_SPILL_PATH to write the out-of-core fact batches there as Parquet before loading them
+    spill_path = os.environ.get('ETL_SPILL_PATH') or None
+    # Set ETL_RUN_PATH to checkpoint a full load there, a failed run then resumes where it stopped
+    main.mainLoop(chunksize=chunksize, incremental=incremental, pattern=pattern, cdc=cdc, out_of_core=out_of_core, spill_path=spill_path,
+                  run_path=run_path)
+    # Set ETL_PROFILE_PATH to write stage timings as <path>.json and <path>.prom
+    if profile_path:
+        profiler.write(profile_path)
+
 if __name__ == '__main__':
     main()
-        
-    
+
+
 
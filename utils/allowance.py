@@ -0,0 +1,93 @@
+import os, json
+import numpy as np
+import pandas as pd
+
+# Optional JSON file with the allowance rules, see AllowanceRules for the format
+rules_path = os.environ.get('ALLOWANCE_RULES_PATH')
+
+class AllowanceRules():
+    # Pay rules evaluated once per policy dimension row and broadcast to the fact
+    # rows through their positions in the dimension, so every rule is a NumPy
+    # operation over the whole batch whatever the number of policies.
+    #
+    # travel_bands: [[upper km, rate multiplier], ...] in increasing order, the last
+    #   upper bound may be null. Each band pays its share of the distance at
+    #   travelallowanceRate * multiplier, like tax brackets.
+    # weather_allowances: {weather: {temperature: amount}}, overrides the
+    #   weatehr allowance of the matching WeatherAllowancePolicy rows.
+    # weather_aliases: {weather: weather}, applied to the source before the
+    #   policy dimensions are built.
+    # holiday_multipliers: {isholiday: multiplier} on the work payment.
+    def __init__(self, travel_bands=None, weather_allowances=None, weather_aliases=None, holiday_multipliers=None):
+        self.travel_bands = travel_bands or [[None, 1.0]]
+        self.weather_allowances = weather_allowances or {}
+        # Heavy rain shares the rain weather allowance policy
+        self.weather_aliases = {'heavy rain': 'rain'} if weather_aliases is None else weather_aliases
+        self.holiday_multipliers = holiday_multipliers or {}
+
+    @classmethod
+    def from_file(cls, path=rules_path):
+        if not path:
+            return cls()
+        with open(path) as file:
+            return cls(**json.load(file))
+
+    def normalize(self, fact_table):
+        # Rewrite weather aliases, mapped once per category instead of once per row
+        if self.weather_aliases:
+            aliases = self.weather_aliases
+            weather = fact_table['weather'].astype('category')
+            fact_table['weather'] = weather.map(lambda value: aliases.get(value, value)).astype('category')
+        return fact_table
+
+    def travel_distance(self, distance):
+        # Distance weighted by the band multipliers
+        distance = np.asarray(distance, dtype='float64')
+        weighted = np.zeros_like(distance)
+        lower = 0.0
+        for upper, multiplier in self.travel_bands:
+            upper = np.inf if upper is None else float(upper)
+            weighted += np.clip(distance - lower, 0.0, upper - lower) * multiplier
+            lower = upper
+        return weighted
+
+    def weather_amounts(self, policy):
+        # Allowance of every WeatherAllowancePolicy row, matrix entries win over the source amount
+        amounts = policy['weatehr allowance'].to_numpy()
+        if self.weather_allowances:
+            matrix = pd.Series({(weather, temperature): amount
+                                for weather, row in self.weather_allowances.items()
+                                for temperature, amount in row.items()})
+            found = matrix.index.get_indexer(pd.MultiIndex.from_frame(policy[['weather', 'temperature']].astype(str)))
+            amounts = np.where(found >= 0, matrix.to_numpy()[found], amounts)
+        return amounts
+
+    def holiday_factors(self, holiday):
+        # Work payment multiplier of every Holiday row
+        return holiday['isholiday'].astype(str).map(self.holiday_multipliers).fillna(1.0).to_numpy(dtype='float64')
+
+    def apply(self, fact_table, travel_policy, weather_policy, holiday):
+        # Each policy argument is (dimension table, position of every fact row in it)
+        travel_table, travel_rows = travel_policy
+        weather_table, weather_rows = weather_policy
+        holiday_table, holiday_rows = holiday
+
+        # Get Travel Allowance amount
+        rates = travel_table['travelallowanceRate'].to_numpy(dtype='float64')[travel_rows]
+        travel_allowance_amount = self.travel_distance(fact_table['travel distance']) * rates
+        fact_table['travel allowance amount'] = travel_allowance_amount
+
+        # Get Weather Allowance Amount
+        weather_allowance_amount = self.weather_amounts(weather_table)[weather_rows]
+        fact_table['weather allowance amount'] = weather_allowance_amount
+
+        # Get Hourly Work Payment
+        work_payment = fact_table['work hours'].to_numpy() * fact_table['job hourly'].to_numpy()
+        factors = self.holiday_factors(holiday_table)
+        if (factors != 1.0).any():
+            work_payment = work_payment * factors[holiday_rows]
+        fact_table['work payment'] = work_payment
+
+        # Get Total Payment
+        fact_table['total pay this job'] = work_payment + travel_allowance_amount + weather_allowance_amount
+        return fact_table
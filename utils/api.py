@@ -2,15 +2,22 @@ from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import jwt, JWTError
 from passlib.context import CryptContext
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import os
 from fastapi.middleware.cors import CORSMiddleware
 import json
-from fastapi import Response
+from functools import lru_cache
+from fastapi import Request, Response, Query
+from fastapi.responses import StreamingResponse
+from typing import Optional
 
 from utils.datasetup import AzureDB
+from utils.cache import ResultCache, VersionStamp
+from utils.queries import EMPLOYEE_PAY, EMPLOYEE_PAY_SUMMARY, EMPLOYEE_GROUPS, MANAGER_PAY, MANAGER_PAY_SUMMARY, MANAGER_GROUPS, split_records
+from utils.queries import EMPLOYEE_PAY_ROWS, manager_pay_rows
+from utils.streaming import json_pages, arrow_pages
 
 
 load_dotenv()
@@ -39,42 +46,52 @@ app.add_middleware(
 pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-# Database simulation
+# Database simulation, passwords are hashed on first login so importing the API stays cheap
 users_db = {
     "manager1": {
         "username": "manager1",
         "full_name": "Manager One",
-        "hashed_password": pwd_context.hash("managerpass"),
+        "password": "managerpass",
         "roles": ["manager"],
         "id": 0
     },
     "john": {
         "username": "john",
         "full_name": "John Smith",
-        "hashed_password": pwd_context.hash("1234"),
+        "password": "1234",
         "roles": ["employee"],
         "id": 1
     },
     "bob": {
         "username": "bob",
         "full_name": "Bob Wong",
-        "hashed_password": pwd_context.hash("1234"),
+        "password": "1234",
         "roles": ["employee"],
         "id": 2
     },
     "ann": {
         "username": "ann",
         "full_name": "Ann Li",
-        "hashed_password": pwd_context.hash("1234"),
+        "password": "1234",
         "roles": ["employee"],
         "id": 3
     }
 }
 
-# SQL database access
+@lru_cache(maxsize=None)
+def hashed_password(username: str):
+    return pwd_context.hash(users_db[username]['password'])
+
+# SQL database access, engine and blob clients are created lazily
 database=AzureDB()
 database.access_container("example-data")
 
+# Query results are cached per endpoint and user until MainETL.load stamps a new version
+result_cache = ResultCache(maxsize=int(os.environ.get('API_CACHE_SIZE', 1024)), ttl=int(os.environ.get('API_CACHE_TTL', 300)))
+etl_version = VersionStamp(database.read_etl_version, ttl=int(os.environ.get('API_VERSION_TTL', 30)))
+# Largest page the record endpoints return
+max_page_size = int(os.environ.get('API_MAX_PAGE_SIZE', 10000))
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -89,7 +106,7 @@ def authenticate_user(username: str, password: str):
     user = users_db.get(username)
     if not user:
         return False
-    if not pwd_context.verify(password, user['hashed_password']):
+    if not pwd_context.verify(password, hashed_password(username)):
         return False
     return user
 
@@ -99,6 +116,50 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+async def current_etag(endpoint: str, user_id: int):
+    version = etl_version.value if etl_version.fresh() else await database.run_async(etl_version.get)
+    return f'"{endpoint}-{user_id}-{version}"'
+
+async def cached_response(request: Request, response: Response, endpoint: str, user_id: int, compute):
+    # Serve a cached result, or 304 when the client already holds the current version
+    etag = await current_etag(endpoint, user_id)
+    if request.headers.get('if-none-match') == etag:
+        return add_cors_headers(Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag}))
+    response.headers['ETag'] = etag
+    # The ETag names the endpoint, user and data version, so it keys the cache too
+    key = etag
+    result = result_cache.get(key)
+    if result is None:
+        result = await compute()
+        result_cache.set(key, result)
+    return result
+
+def read_pay(summary_table, summary_query, fact_query, groups, params=None):
+    # Read the pre-aggregated summary table when the last load built it, else scan the fact table once
+    query = summary_query if database.table_exists(summary_table) else fact_query
+    return json.dumps(split_records(database.get_sql_table(query, params), groups))
+
+async def streamed_records(request: Request, endpoint: str, user_id: int, query: str, params: dict, key: str, format: str):
+    # Page of rows serialized while they are fetched, as JSON or as an Arrow IPC stream.
+    # Pages are not cached, the ETag covers the query string so unchanged pages still get 304.
+    etag = await current_etag(f'{endpoint}?{request.url.query}', user_id)
+    if request.headers.get('if-none-match') == etag:
+        return add_cors_headers(Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag}))
+    rows = database.stream_sql_rows_async(query, params)
+    if format == 'arrow':
+        response = StreamingResponse(arrow_pages(rows), media_type='application/vnd.apache.arrow.stream')
+    else:
+        response = StreamingResponse(json_pages(rows, key, params['limit']), media_type='application/json')
+    response.headers['ETag'] = etag
+    return add_cors_headers(response)
+
+def date_range(start: Optional[date], end: Optional[date]):
+    # Inclusive Date_id bounds, open ends cover every date
+    return {
+        'start': int(start.strftime('%Y%m%d')) if start else 0,
+        'end': int(end.strftime('%Y%m%d')) if end else 99991231,
+    }
+
 def add_cors_headers(response: Response):
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Methods'] = 'POST, GET, OPTIONS'
@@ -158,47 +219,37 @@ async def read_common_data(response: Response, current_user: User = Depends(get_
     return json.dumps({"data": "This is common data available to all authenticated users"})
 
 @app.get("/data/employee")
-async def read_employee_data(response: Response, current_user: User = Depends(check_user_role("employee"))):
+async def read_employee_data(request: Request, response: Response, current_user: User = Depends(check_user_role("employee"))):
     
     response = add_cors_headers(response) 
     id = current_user.id
-    total_pay1 = f'''
-        SELECT date, SUM([work payment]) as Hourly_Pay, SUM([travel allowance amount]) as Travel_Pay, SUM([weather allowance amount]) as Weather_Pay, SUM([total pay this job]) as Total_Pay  
-        FROM [dbo].[Total_Pay_Fact] 
-        JOIN [dbo].[Date_dim] ON [dbo].[Total_Pay_Fact].Date_id = [dbo].[Date_dim].Date_id
-        WHERE [dbo].[Total_Pay_Fact].Staff_id = {id}
-        GROUP BY date
-    '''
-    
-    total_pay2 = f'''
-        SELECT date, SUM([work hours]) as Total_Hours 
-        FROM [dbo].[Total_Pay_Fact] 
-        JOIN [dbo].[Date_dim] ON [dbo].[Total_Pay_Fact].Date_id = [dbo].[Date_dim].Date_id
-        WHERE [dbo].[Total_Pay_Fact].Staff_id = {id}
-        GROUP BY date
-    '''
-    queries = [total_pay1, total_pay2]
-    return json.dumps([database.get_sql_table(query) for query in queries])
+    return await cached_response(request, response, 'employee', id, lambda: database.run_async(read_pay, 'Staff_Month_Pay_Agg', EMPLOYEE_PAY_SUMMARY, EMPLOYEE_PAY, EMPLOYEE_GROUPS, {'staff_id': id}))
 
 @app.get("/data/manager")
-async def read_manager_data(response: Response, current_user: User = Depends(check_user_role("manager"))):
+async def read_manager_data(request: Request, response: Response, current_user: User = Depends(check_user_role("manager"))):
     response = add_cors_headers(response) 
-    total_pay1 = '''
-        SELECT Name, SUM([work payment]) as Hourly_Pay, SUM([travel allowance amount]) as Travel_Pay, SUM([weather allowance amount]) as Weather_Pay 
-        FROM [dbo].[Total_Pay_Fact] 
-        JOIN [dbo].[Staff_dim] ON [dbo].[Total_Pay_Fact].Staff_id = [dbo].[Staff_dim].Staff_id
-        GROUP BY Name
-    '''
-    
-    total_pay2 = '''
-        SELECT Name, SUM([total pay this job]) as Total_Pay 
-        FROM [dbo].[Total_Pay_Fact] 
-        JOIN [dbo].[Staff_dim] ON [dbo].[Total_Pay_Fact].Staff_id = [dbo].[Staff_dim].Staff_id
-        GROUP BY Name
-    '''
-    queries = [total_pay1, total_pay2]
-    return json.dumps([database.get_sql_table(query) for query in queries])
-    
+    return await cached_response(request, response, 'manager', current_user.id, lambda: database.run_async(read_pay, 'Staff_Pay_Agg', MANAGER_PAY_SUMMARY, MANAGER_PAY, MANAGER_GROUPS))
+
+# Streamed, paginated records. Pass the next_cursor of a page (for Arrow, the key of its
+# last row) as cursor to get the next one; the last page has fewer than limit rows.
+@app.get("/data/employee/records")
+async def read_employee_records(request: Request, start: Optional[date] = None, end: Optional[date] = None, cursor: int = 0,
+                                limit: int = Query(1000, ge=1, le=max_page_size), format: str = Query('json', pattern='^(json|arrow)$'),
+                                current_user: User = Depends(check_user_role("employee"))):
+    # Daily pay of the current employee, keyed by Date_id
+    params = {'staff_id': current_user.id, 'cursor': cursor, 'limit': limit, **date_range(start, end)}
+    return await streamed_records(request, 'employee-records', current_user.id, EMPLOYEE_PAY_ROWS, params, 'Date_id', format)
+
+@app.get("/data/manager/records")
+async def read_manager_records(request: Request, start: Optional[date] = None, end: Optional[date] = None, department: Optional[str] = None,
+                               cursor: int = 0, limit: int = Query(1000, ge=1, le=max_page_size), format: str = Query('json', pattern='^(json|arrow)$'),
+                               current_user: User = Depends(check_user_role("manager"))):
+    # Pay of every staff member, keyed by Natural Key Staff ID
+    params = {'cursor': cursor, 'limit': limit, **date_range(start, end)}
+    if department:
+        params['department'] = department
+    return await streamed_records(request, 'manager-records', current_user.id, manager_pay_rows(department=bool(department)), params, 'Staff_Key', format)
+
 # Running the app with Uvicorn
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,57 @@
+import os, shutil
+import pandas as pd
+
+# Format of the local table snapshots written to ./data: csv or parquet
+output_format = os.environ.get('ETL_OUTPUT_FORMAT', 'csv')
+
+def snapshot_path(name, fmt=output_format, folder='./data'):
+    return os.path.join(folder, f'{name}.{fmt}')
+
+def to_arrow(frame):
+    import pyarrow as pa
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    # Dictionary encode string columns, dimension attributes repeat a lot and read back as categoricals
+    for i, field in enumerate(table.schema):
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            table = table.set_column(i, field.name, table.column(i).dictionary_encode())
+    return table
+
+def write_snapshot(name, frame, append=False, fmt=output_format, folder='./data'):
+    # Save a table locally. Parquet snapshots are folders with one file per
+    # write, so batches can be appended without rewriting earlier ones.
+    path = snapshot_path(name, fmt, folder)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        if not append and os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+        part = os.path.join(path, f'part-{len(os.listdir(path)):05d}.parquet')
+        pq.write_table(to_arrow(frame), part)
+    else:
+        # Appending to a missing snapshot starts a new file with a header
+        append = append and os.path.exists(path)
+        frame.to_csv(path, mode='a' if append else 'w', header=not append)
+
+def read_arrow(name, fmt='parquet', folder='./data', columns=None):
+    # Memory mapped Arrow table of a parquet snapshot, no copy into pandas
+    import pyarrow.parquet as pq
+    return pq.read_table(snapshot_path(name, fmt, folder), columns=columns, memory_map=True)
+
+def arrow_to_pandas(table):
+    # Numeric columns are converted one block each and Arrow buffers are released as they
+    # are converted, so the peak stays near one copy; strings are always copied into pandas
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+def read_snapshot(name, fmt=output_format, folder='./data', columns=None):
+    # Load a local snapshot written by write_snapshot as a DataFrame
+    if fmt == 'parquet':
+        return arrow_to_pandas(read_arrow(name, fmt, folder, columns))
+    frame = pd.read_csv(snapshot_path(name, fmt, folder), index_col=0)
+    return frame if columns is None else frame[columns]
+
+def read_snapshot_parts(name, folder='./data', columns=None):
+    # DataFrame of every file of a parquet snapshot in write order, one file in memory at a time
+    import pyarrow.parquet as pq
+    path = snapshot_path(name, 'parquet', folder)
+    for part in sorted(os.listdir(path)):
+        yield arrow_to_pandas(pq.read_table(os.path.join(path, part), columns=columns, memory_map=True))
@@ -0,0 +1,54 @@
+import time, threading
+from collections import OrderedDict
+
+class ResultCache():
+    # Thread safe LRU cache whose entries expire after ttl seconds
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            stored, value = entry
+            if time.monotonic() - stored > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class VersionStamp():
+    # Remembers the warehouse data version for ttl seconds, so most requests
+    # can be answered from the cache without touching the database
+    def __init__(self, read, ttl=30):
+        self.read = read
+        self.ttl = ttl
+        self.value = None
+        self.checked = 0.0
+        self.lock = threading.Lock()
+
+    def fresh(self):
+        return self.value is not None and time.monotonic() - self.checked <= self.ttl
+
+    def get(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.value is None or now - self.checked > self.ttl:
+                self.value = self.read()
+                self.checked = now
+            return self.value
@@ -0,0 +1,41 @@
+import os
+import pandas as pd
+from utils.artifacts import snapshot_path, write_snapshot, read_snapshot
+
+# Date range covered by the generated calendar, widened to whole years when
+# the source has dates outside of it
+calendar_start = os.environ.get('CALENDAR_START', '2020-01-01')
+calendar_end = os.environ.get('CALENDAR_END', '2030-12-31')
+
+def date_keys(dates):
+    # Integer yyyymmdd key of every date
+    dates = pd.DatetimeIndex(dates)
+    return (dates.year * 10000 + dates.month * 100 + dates.day).to_numpy(dtype='int32')
+
+def generate_calendar(start=calendar_start, end=calendar_end):
+    # One row per day with its calendar attributes
+    days = pd.date_range(start, end, freq='D')
+    calendar = pd.DataFrame({
+        'Date_id': date_keys(days),
+        'Full_Date': days,
+        'Year': days.year.astype('int16'),
+        'Quarter': days.quarter.astype('int8'),
+        'Month': days.month.astype('int8'),
+        'Week': days.isocalendar().week.to_numpy(dtype='int8'),
+        'Weekday': (days.dayofweek + 1).astype('int8'),
+        'Day_Name': pd.Categorical(days.day_name()),
+        # The dashboards group by month name, so it keeps the column name the source used
+        'date': pd.Categorical(days.month_name()),
+        # Same values as the Holiday_dim natural key
+        'isholiday': pd.Categorical(['no'] * len(days), categories=['no', 'yes']),
+    })
+    return calendar
+
+def load_calendar(start=calendar_start, end=calendar_end, folder='./data'):
+    # Generated once per range and cached as a parquet artifact
+    name = f"Calendar_{pd.Timestamp(start):%Y%m%d}_{pd.Timestamp(end):%Y%m%d}"
+    if os.path.exists(snapshot_path(name, 'parquet', folder)):
+        return read_snapshot(name, 'parquet', folder)
+    calendar = generate_calendar(start, end)
+    write_snapshot(name, calendar, fmt='parquet', folder=folder)
+    return calendar
@@ -0,0 +1,58 @@
+import os, json, shutil, threading
+from utils.artifacts import write_snapshot, read_snapshot
+
+# Optional run directory, a failed run is resumed from its checkpoints there
+run_path = os.environ.get('ETL_RUN_PATH')
+
+class RunCheckpoint():
+    # Completed steps of a run and the frames needed to resume after them, kept in a
+    # local run directory: state.json lists the steps done so far (extract, transform,
+    # then every loaded table) and frames are Parquet snapshots next to it. A run
+    # started with other settings than the checkpointed one starts over.
+    def __init__(self, path=run_path, settings=None):
+        self.path = path
+        self.settings = settings or {}
+        self.lock = threading.Lock()
+        self.completed = []
+        state = self.read_state()
+        if state is not None and state['settings'] == self.settings:
+            self.completed = state['completed']
+        elif state is not None:
+            print(f'Run settings changed, discarding the checkpoints in {path}')
+            self.clear()
+        if self.completed:
+            print(f"Resuming run from {path}, done: {', '.join(self.completed)}")
+
+    def state_path(self):
+        return os.path.join(self.path, 'state.json')
+
+    def read_state(self):
+        if not os.path.exists(self.state_path()):
+            return None
+        with open(self.state_path()) as file:
+            return json.load(file)
+
+    def done(self, step):
+        with self.lock:
+            return step in self.completed
+
+    def complete(self, step):
+        # Written to a temporary file first, so a crash never leaves a partial state behind
+        with self.lock:
+            self.completed.append(step)
+            os.makedirs(self.path, exist_ok=True)
+            with open(f'{self.state_path()}.tmp', 'w') as file:
+                json.dump({'settings': self.settings, 'completed': self.completed}, file, indent=2)
+            os.replace(f'{self.state_path()}.tmp', self.state_path())
+
+    def write_frame(self, name, frame):
+        write_snapshot(name, frame, fmt='parquet', folder=self.path)
+
+    def read_frame(self, name):
+        return read_snapshot(name, 'parquet', self.path)
+
+    def clear(self):
+        # Called once the run finished, the next run starts from scratch
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        self.completed = []
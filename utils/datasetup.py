@@ -1,11 +1,18 @@
-import os, pyodbc
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient
+import os
 import io
+import re
+import fnmatch
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import Column, ForeignKeyConstraint, MetaData, Table, create_engine, inspect, text
+from sqlalchemy.types import BigInteger, Boolean, DateTime, Double, NVARCHAR
 import pandas as pd
 import json
+from utils.storage import AzureStorage, LocalStorage
+from utils.profiler import profiler
 
 load_dotenv()
 
@@ -17,114 +24,442 @@ server = os.environ.get('SERVER')
 database = os.environ.get('DATABASE')
 account_storage = os.environ.get('ACCOUNT_STORAGE')
 connect_str = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
+# Size in bytes of each ranged GET when streaming blobs
+blob_chunk_size = int(os.environ.get('BLOB_CHUNK_SIZE', 4 * 1024 * 1024))
 
-# Using pyodbc
-engine = create_engine(f'mssql+pyodbc://{username}:{password}@{server}/{database}?driver=ODBC+Driver+18+for+SQL+Server')
+# Blob storage adapter: azure, or local to read containers from folders under LOCAL_STORAGE_PATH
+storage_backend = os.environ.get('STORAGE_BACKEND', 'azure')
+local_storage_path = os.environ.get('LOCAL_STORAGE_PATH', './data/blobs')
+
+# Optional SQLAlchemy URL of an embedded warehouse used instead of Azure SQL,
+# e.g. duckdb:///./data/warehouse.duckdb or sqlite:///./data/warehouse.db
+warehouse_url = os.environ.get('WAREHOUSE_URL')
+
+# Bulk load settings: executemany batches with pyodbc fast_executemany
+bulk_load = os.environ.get('SQL_BULK_LOAD', '0') == '1'
+bulk_batch_size = int(os.environ.get('SQL_BULK_BATCH_SIZE', 50000))
+bulk_tablock = os.environ.get('SQL_BULK_TABLOCK', '0') == '1'
+
+# Connection pool settings shared by every AzureDB instance
+pool_size = int(os.environ.get('SQL_POOL_SIZE', 5))
+pool_max_overflow = int(os.environ.get('SQL_POOL_MAX_OVERFLOW', 10))
+pool_pre_ping = os.environ.get('SQL_POOL_PRE_PING', '1') == '1'
+pool_recycle = int(os.environ.get('SQL_POOL_RECYCLE', 1800))
+# Blocking queries issued from async code run on at most this many threads
+db_max_concurrency = int(os.environ.get('DB_MAX_CONCURRENCY', pool_size))
+# Rows fetched from the cursor at a time by streamed queries
+sql_fetch_size = int(os.environ.get('SQL_FETCH_SIZE', 1000))
+# Streamed queries holding a connection at once, by default the connections the SQL threads leave free
+db_max_streams = int(os.environ.get('DB_MAX_STREAMS', max(1, pool_size + pool_max_overflow - db_max_concurrency)))
+
+# Engine, credential and blob client are created on first use, not at import
+_engine = None
+_credential = None
+_blob_service_client = None
+_executor = None
+_stream_slots = None
+_lock = threading.Lock()
+
+def get_engine():
+    # Using pyodbc
+    global _engine
+    with _lock:
+        if _engine is None:
+            _engine = create_engine(
+                warehouse_url or f'mssql+pyodbc://{username}:{password}@{server}/{database}?driver=ODBC+Driver+18+for+SQL+Server',
+                pool_size=pool_size,
+                max_overflow=pool_max_overflow,
+                pool_pre_ping=pool_pre_ping,
+                pool_recycle=pool_recycle,
+            )
+    return _engine
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=db_max_concurrency, thread_name_prefix='sql')
+    return _executor
+
+def get_stream_slots():
+    global _stream_slots
+    with _lock:
+        if _stream_slots is None:
+            _stream_slots = asyncio.Semaphore(db_max_streams)
+    return _stream_slots
+
+def get_credential():
+    global _credential
+    with _lock:
+        if _credential is None:
+            from azure.identity import DefaultAzureCredential
+            _credential = DefaultAzureCredential()
+    return _credential
+
+def get_blob_service_client():
+    global _blob_service_client
+    with _lock:
+        if _blob_service_client is None:
+            from azure.storage.blob import BlobServiceClient
+            _blob_service_client = BlobServiceClient.from_connection_string(connect_str, max_single_get_size=blob_chunk_size, max_chunk_get_size=blob_chunk_size)
+            # _blob_service_client = BlobServiceClient(f"https://{account_storage}.blob.core.windows.net", credential=get_credential())
+    return _blob_service_client
+
+def is_mssql():
+    return get_engine().dialect.name == 'mssql'
+
+def sql(query):
+    # Queries are written with T-SQL quoting, other backends get the same
+    # statement with standard quoted identifiers and no dbo schema
+    if not is_mssql():
+        query = re.sub(r'\[dbo\]\.', '', query)
+        query = re.sub(r'\[([^\]]+)\]', r'"\1"', query)
+        query = re.sub(r'OFFSET 0 ROWS FETCH NEXT (:\w+) ROWS ONLY', r'LIMIT \1', query)
+    return text(query)
+
+def sql_types(frame, dtype=None):
+    # Explicit column types for a new table instead of the ones to_sql infers
+    types = {}
+    for column, kind in frame.dtypes.items():
+        if pd.api.types.is_bool_dtype(kind):
+            types[column] = Boolean()
+        elif pd.api.types.is_integer_dtype(kind):
+            types[column] = BigInteger()
+        elif pd.api.types.is_float_dtype(kind):
+            types[column] = Double()
+        elif pd.api.types.is_datetime64_any_dtype(kind):
+            types[column] = DateTime()
+        else:
+            # Leave headroom for longer values arriving in later batches
+            length = frame[column].dropna().astype(str).str.len().max()
+            types[column] = NVARCHAR(255) if pd.isna(length) or length <= 255 else NVARCHAR(None)
+    if dtype:
+        types.update(dtype)
+    return types
+
+def create_table(con, table_name, frame, dtype=None, primary=None, foreign_keys=None):
+    # Replace a table with one whose primary and foreign keys are declared up
+    # front, for backends that cannot add constraints with ALTER TABLE
+    metadata = MetaData()
+    types = sql_types(frame, dtype)
+    for column, reference in (foreign_keys or {}).items():
+        Table(reference, metadata, Column(column, BigInteger, primary_key=True))
+    columns = [Column(column, types[column], primary_key=column == primary, autoincrement=False, nullable=column != primary) for column in frame.columns]
+    constraints = [ForeignKeyConstraint([column], [f'{reference}.{column}']) for column, reference in (foreign_keys or {}).items()]
+    table = Table(table_name, metadata, *columns, *constraints)
+    table.drop(con, checkfirst=True)
+    table.create(con)
+
+def bulk_insert(con, table_name, frame, batch_size=bulk_batch_size, tablock=False):
+    # Insert a DataFrame with one executemany call per batch. With pyodbc and
+    # fast_executemany each batch is sent as a single parameter array.
+    preparer = con.dialect.identifier_preparer
+    if con.dialect.name == 'duckdb':
+        # DuckDB scans the DataFrame directly, which is far faster than executemany
+        duck = con.connection.driver_connection
+        duck.register('bulk_batch', frame)
+        try:
+            columns = ', '.join(preparer.quote(column) for column in frame.columns)
+            duck.execute(f'INSERT INTO {preparer.quote(table_name)} ({columns}) SELECT {columns} FROM bulk_batch')
+        finally:
+            duck.unregister('bulk_batch')
+        return
+    mssql = con.dialect.name == 'mssql'
+    table = f'[dbo].[{table_name}]' if mssql else preparer.quote(table_name)
+    # TABLOCK lets SQL Server minimally log inserts into a heap under simple or bulk-logged recovery
+    hint = ' WITH (TABLOCK)' if tablock and mssql else ''
+    columns = ', '.join(preparer.quote(column) for column in frame.columns)
+    values = ', '.join('?' * len(frame.columns))
+    statement = f'INSERT INTO {table}{hint} ({columns}) VALUES ({values})'
+
+    cursor = con.connection.cursor()
+    if hasattr(cursor, 'fast_executemany'):
+        cursor.fast_executemany = True
+    try:
+        for start in range(0, len(frame), batch_size):
+            batch = frame.iloc[start:start + batch_size].astype(object)
+            batch = batch.where(batch.notna(), None)
+            for column in frame.columns[frame.dtypes.map(pd.api.types.is_datetime64_any_dtype)]:
+                # Plain datetime objects, some drivers do not accept pandas Timestamps
+                batch[column] = pd.Series([None if value is None else value.to_pydatetime() for value in batch[column]], index=batch.index, dtype=object)
+            cursor.executemany(statement, list(batch.itertuples(index=False, name=None)))
+    finally:
+        cursor.close()
+
+class BlobChunkReader(io.RawIOBase):
+    # Read-only file object over an iterator of byte chunks, so pandas can parse
+    # a blob download stream without the whole blob being held in memory
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = memoryview(b'')
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self.buffer):
+            try:
+                self.buffer = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+            self.bytes_read += len(self.buffer)
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
 
 class AzureDB():
-    def __init__(self, local_path = "./data", account_storage = account_storage):
+    def __init__(self, local_path = "./data", account_storage = account_storage, storage = None):
         self.local_path = local_path
         self.account_url = f"https://{account_storage}.blob.core.windows.net"
-        self.default_credential = DefaultAzureCredential()
-        self.blob_service_client = BlobServiceClient.from_connection_string(connect_str)
-        # self.blob_service_client = BlobServiceClient(self.account_url, credential=self.default_credential)
-        
+        self.container_name = None
+        # Blob operations go through a storage adapter: Azure by default, a local folder with STORAGE_BACKEND=local
+        if storage is None:
+            if storage_backend == 'local':
+                storage = LocalStorage(local_storage_path, chunk_size=blob_chunk_size)
+            else:
+                storage = AzureStorage(get_blob_service_client)
+        self.storage = storage
+
+    @property
+    def default_credential(self):
+        return get_credential()
+
+    @property
+    def blob_service_client(self):
+        return get_blob_service_client()
+
     def access_container(self, container_name): 
-        # Use this function to create/access a new container
-        try:
-            # Creating container if not exist
-            self.container_client = self.blob_service_client.create_container(container_name)
-            print(f"Creating container {container_name} since not exist in database")
-            self.container_name = container_name
-    
-        except Exception as ex:
-            print(f"Acessing container {container_name}")
-            # Access the container
-            self.container_client = self.blob_service_client.get_container_client(container=container_name)
-            self.container_name = container_name
+        # Use this function to create/access a new container, the container is
+        # only contacted the first time it is used
+        self.container_name = container_name
+        self.storage.access_container(container_name)
             
     def delete_container(self):
         # Delete a container
         print("Deleting blob container...")
-        self.container_client.delete_container()
+        self.storage.delete_container()
         print("Done")
         
     def upload_blob(self, blob_name, blob_data = None):
         # Create a file in the local data directory to upload as blob to Azure
         local_file_name = blob_name
         upload_file_path = os.path.join(self.local_path, local_file_name)
-        blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=local_file_name)
         print("\nUploading to Azure Storage as blob:\n\t" + local_file_name)
 
         if blob_data is not None:
-            blob_client.create_blob_from_text(container_name=self.container_name, blob_name=blob_name, text=blob_data)
+            self.storage.upload_blob(blob_name, blob_data)
         else:
             # Upload the created file
             with open(file=upload_file_path, mode="rb") as data:
-                blob_client.upload_blob(data)
+                self.storage.upload_blob(blob_name, data)
                 
-    def list_blobs(self):
+    def list_blobs(self, prefix=None):
         print("\nListing blobs...")
         # List the blobs in the container
-        blob_list = self.container_client.list_blobs()
+        blob_list = self.storage.list_blobs(prefix)
         for blob in blob_list:
-            print("\t" + blob.name)  
+            print("\t" + blob)  
+        return blob_list
             
     def download_blob(self, blob_name):
         # Download the blob to local storage
         download_file_path = os.path.join(self.local_path, blob_name)
         print("\nDownloading blob to \n\t" + download_file_path)
-        with open(file=download_file_path, mode="wb") as download_file:
-                download_file.write(self.container_client.download_blob(blob_name).readall())
+        self.storage.download_blob(blob_name, download_file_path)
                 
     def delete_blob(self, container_name: str, blob_name: str):
         # Deleting a blob
         print("\nDeleting blob " + blob_name)
-        blob_client = self.blob_service_client.get_blob_client(container=container_name, blob=blob_name)
-        blob_client.delete_blob()
+        self.storage.delete_blob(blob_name, container_name)
+
+    def find_blobs(self, pattern):
+        # Blob names matching a prefix or glob pattern such as 'depot-*/2024-*.csv', in name order.
+        # Only the part before the first wildcard is sent to the storage listing.
+        prefix = re.split(r'[*?\[]', pattern, maxsplit=1)[0]
+        blob_list = self.list_blobs(prefix or None)
+        if prefix != pattern:
+            blob_list = [blob for blob in blob_list if fnmatch.fnmatchcase(blob, pattern)]
+        return sorted(blob_list)
+
+    def open_blob(self, blob_name):
+        # Buffered binary file object streaming the blob chunk by chunk
+        return io.BufferedReader(BlobChunkReader(self.storage.chunks(blob_name)), buffer_size=blob_chunk_size)
         
-    def access_blob_csv(self, blob_name):
+    def access_blob_csv(self, blob_name, **read_options):
         # Read the csv blob from Azure
         try:
             print(f"Acessing blob {blob_name}")
             
-            df = pd.read_csv(io.StringIO(self.container_client.download_blob(blob_name).readall().decode('utf-8')))  
+            with profiler.stage(f'extract/{blob_name}') as stage:
+                df = pd.read_csv(self.open_blob(blob_name), **read_options)  
+                stage['frame'] = df
             return df      
         except Exception as ex:
             print('Exception:')
             print(ex)
             
+    def read_blob_csv(self, blob_name, **read_options):
+        # Read a whole csv blob, returns the DataFrame and the number of bytes downloaded.
+        # read_options are passed to pd.read_csv, e.g. dtype and parse_dates.
+        with profiler.stage(f'extract/{blob_name}') as stage:
+            reader = BlobChunkReader(self.storage.chunks(blob_name))
+            frame = pd.read_csv(io.BufferedReader(reader, buffer_size=blob_chunk_size), **read_options)
+            stage['frame'] = frame
+        return frame, reader.bytes_read
+
+    def stream_blob_csv(self, blob_name, chunksize=100000, **read_options):
+        # Read the csv blob from Azure in batches of at most chunksize rows
+        print(f"Streaming blob {blob_name}")
+        with pd.read_csv(self.open_blob(blob_name), chunksize=chunksize, **read_options) as batches:
+            while True:
+                # Only the time spent reading counts, not the time the consumer holds the batch
+                start = time.perf_counter()
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                profiler.record(f'extract/{blob_name}', time.perf_counter() - start, frame=batch)
+                yield batch
+            
     
-    def upload_dataframe_sqldatabase(self, blob_name, blob_data):
+    def upload_dataframe_sqldatabase(self, blob_name, blob_data, bulk=None, batch_size=bulk_batch_size, dtype=None, tablock=bulk_tablock, primary_key=True, foreign_keys=None):
         print("\nUploading to Azure SQL server as table:\n\t" + blob_name)
-        blob_data.to_sql(blob_name, engine, if_exists='replace', index=False)
-        primary = blob_name.replace('dim', 'id')
-        if 'fact' in blob_name.lower():
-            with engine.connect() as con:
-                trans = con.begin()
-                con.execute(text(f'ALTER TABLE [dbo].[{blob_name}] alter column {blob_name}_id bigint NOT NULL'))
-                con.execute(text(f'ALTER TABLE [dbo].[{blob_name}] ADD CONSTRAINT [PK_{blob_name}] PRIMARY KEY CLUSTERED ([{blob_name}_id] ASC);'))
-                trans.commit() 
-        else:        
-            with engine.connect() as con:
-                trans = con.begin()
+        primary = None
+        if primary_key:
+            primary = f'{blob_name}_id' if 'fact' in blob_name.lower() else blob_name.replace('dim', 'id')
+        # Table creation, rows and primary key are committed together or rolled back together
+        with profiler.stage(f'load/{blob_name}', frame=blob_data), get_engine().begin() as con:
+            if not is_mssql():
+                # Embedded backends get keys declared at creation, foreign_keys maps
+                # column -> referenced table; Azure SQL adds them with ALTER TABLE instead
+                with profiler.stage(f'load/{blob_name}/create'):
+                    create_table(con, blob_name, blob_data, dtype, primary, foreign_keys)
+                with profiler.stage(f'load/{blob_name}/insert', rows=len(blob_data)):
+                    bulk_insert(con, blob_name, blob_data, batch_size=batch_size)
+                return
+            if bulk or (bulk is None and bulk_load):
+                # Create the table with explicit types, then insert the rows in batches
+                # while it is still a heap; the primary key is added afterwards
+                with profiler.stage(f'load/{blob_name}/create'):
+                    blob_data.head(0).to_sql(blob_name, con, if_exists='replace', index=False, dtype=sql_types(blob_data, dtype))
+                with profiler.stage(f'load/{blob_name}/insert', rows=len(blob_data)):
+                    bulk_insert(con, blob_name, blob_data, batch_size=batch_size, tablock=tablock)
+            else:
+                with profiler.stage(f'load/{blob_name}/to_sql', rows=len(blob_data)):
+                    blob_data.to_sql(blob_name, con, if_exists='replace', index=False)
+            if primary is None:
+                return
+            with profiler.stage(f'load/{blob_name}/alter'):
                 con.execute(text(f'ALTER TABLE [dbo].[{blob_name}] alter column {primary} bigint NOT NULL'))
                 con.execute(text(f'ALTER TABLE [dbo].[{blob_name}] ADD CONSTRAINT [PK_{blob_name}] PRIMARY KEY CLUSTERED ([{primary}] ASC);'))
-                trans.commit() 
                 
-    def append_dataframe_sqldatabase(self, blob_name, blob_data):
+    def append_dataframe_sqldatabase(self, blob_name, blob_data, bulk=None, batch_size=bulk_batch_size, tablock=bulk_tablock):
         print("\nAppending to table:\n\t" + blob_name)
-        blob_data.to_sql(blob_name, engine, if_exists='append', index=False)
+        with profiler.stage(f'load/{blob_name}/append', frame=blob_data):
+            if bulk or (bulk is None and bulk_load) or not is_mssql():
+                with get_engine().begin() as con:
+                    bulk_insert(con, blob_name, blob_data, batch_size=batch_size, tablock=tablock)
+            else:
+                blob_data.to_sql(blob_name, get_engine(), if_exists='append', index=False)
     
+    def merge_sqldatabase(self, table_name, key, columns, stage_name=None, update_columns=None, deleted_name=None, insert=True):
+        # Apply a staged delta in one transaction: keys listed in the deleted_name staging
+        # table are removed, rows of stage_name are updated or, with insert, inserted by key
+        print("\nMerging into table:\n\t" + table_name)
+        if update_columns is None:
+            update_columns = [column for column in columns if column != key]
+        names = ', '.join(f'[{column}]' for column in columns)
+        with profiler.stage(f'load/{table_name}/merge'), get_engine().begin() as con:
+            if deleted_name is not None:
+                con.execute(sql(f'DELETE FROM [dbo].[{table_name}] WHERE [{key}] IN (SELECT [{key}] FROM [dbo].[{deleted_name}])'))
+            if stage_name is None:
+                return
+            updates = ', '.join(f'[{column}] = source.[{column}]' for column in update_columns)
+            if con.dialect.name in ('mssql', 'duckdb'):
+                values = ', '.join(f'source.[{column}]' for column in columns)
+                inserts = f'WHEN NOT MATCHED BY TARGET THEN INSERT ({names}) VALUES ({values})' if insert else ''
+                con.execute(sql(f'MERGE INTO [dbo].[{table_name}] AS target USING [dbo].[{stage_name}] AS source ON target.[{key}] = source.[{key}] '
+                                f'WHEN MATCHED THEN UPDATE SET {updates} {inserts};'))
+            elif not insert:
+                con.execute(sql(f'UPDATE [dbo].[{table_name}] SET {updates} FROM [dbo].[{stage_name}] AS source WHERE [dbo].[{table_name}].[{key}] = source.[{key}]'))
+            else:
+                # SQLite has no MERGE, replace the matched rows instead
+                con.execute(sql(f'DELETE FROM [dbo].[{table_name}] WHERE [{key}] IN (SELECT [{key}] FROM [dbo].[{stage_name}])'))
+                con.execute(sql(f'INSERT INTO [dbo].[{table_name}] ({names}) SELECT {names} FROM [dbo].[{stage_name}]'))
+
     def delete_sqldatabase(self, table_name):
-        with engine.connect() as con:
+        with get_engine().connect() as con:
             trans = con.begin()
-            con.execute(text(f"DROP TABLE [dbo].[{table_name}]"))
+            con.execute(sql(f"DROP TABLE [dbo].[{table_name}]"))
             trans.commit()
             
-    def get_sql_table(self, query):        
-        # Create connection and fetch data using Pandas        
-        df = pd.read_sql_query(query, engine)
+    def table_exists(self, table_name):
+        return inspect(get_engine()).has_table(table_name, schema='dbo' if is_mssql() else None)
+
+    def table_columns(self, table_name):
+        # Column names of a warehouse table, read from an empty result since
+        # not every backend supports column reflection
+        with get_engine().connect() as con:
+            return list(con.execute(sql(f'SELECT * FROM [dbo].[{table_name}] WHERE 1 = 0')).keys())
+
+    def get_max_id(self, table_name, column):
+        # Highest key stored in a warehouse table, 0 when it is missing or empty
+        if not self.table_exists(table_name):
+            return 0
+        with get_engine().connect() as con:
+            max_id = con.execute(sql(f'SELECT MAX([{column}]) FROM [dbo].[{table_name}]')).scalar()
+        return int(max_id or 0)
+
+    def write_etl_version(self):
+        # Stamp the warehouse after a load so API caches know the data changed
+        version = time.time_ns()
+        stamp = pd.DataFrame({'version': [version], 'loaded_at': [pd.Timestamp.now()]})
+        self.upload_dataframe_sqldatabase('ETL_Version', blob_data=stamp, primary_key=False)
+        return version
+
+    def read_etl_version(self):
+        return self.get_max_id('ETL_Version', 'version')
+
+    def get_sql_table(self, query, params=None):        
+        # Create connection and fetch data using Pandas, params are bound to :name placeholders
+        df = pd.read_sql_query(sql(query), get_engine(), params=params)
         # Convert DataFrame to the specified JSON format
         result = df.to_dict(orient='records')
         return result
+
+    def stream_sql_rows(self, query, params=None, batch_size=sql_fetch_size):
+        # Yield the column names, then the rows in lists of at most batch_size, on a
+        # server-side cursor where the driver has one, so the result is never held at once
+        with get_engine().connect() as con:
+            result = con.execution_options(stream_results=True).execute(sql(query), params or {})
+            yield list(result.keys())
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+
+    async def run_async(self, func, *args):
+        # Run a blocking call on the bounded SQL thread pool without stalling the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), func, *args)
+
+    async def stream_sql_rows_async(self, query, params=None, batch_size=sql_fetch_size):
+        # stream_sql_rows for async code: every fetch runs on the bounded SQL thread pool, and
+        # a stream waits for one of DB_MAX_STREAMS slots before it takes a connection, so slow
+        # clients cannot hold the connections the other endpoints need
+        async with get_stream_slots():
+            rows = self.stream_sql_rows(query, params, batch_size)
+            try:
+                while True:
+                    batch = await self.run_async(next, rows, None)
+                    if batch is None:
+                        break
+                    yield batch
+            finally:
+                # Also when the client disconnects, the connection goes back to the pool
+                await self.run_async(rows.close)
+
+    async def get_sql_table_async(self, query, params=None):
+        return await self.run_async(self.get_sql_table, query, params)
@@ -1,66 +1,343 @@
 from utils.datasetup import *
+from utils.artifacts import write_snapshot
+from utils.schema import row_hash
+from utils.calendar_dim import calendar_start, calendar_end, load_calendar
+from utils.parallel_transform import KeyIndex, CalendarIndex
+import numpy as np
 import pandas as pd
 
 blob_name="ETL_Example_Data.csv"
 database=AzureDB()
 database.access_container("example-data")
-df = database.access_blob_csv(blob_name=blob_name)
 
 class ModelAbstract():
     def __init__(self):
         self.columns = None
         self.dimension_table = None
-        
-    def dimension_generator(self, name:str, columns:list):
-        dim = df[columns]
-        dim = dim.drop_duplicates()
-        # Creating primary key for dimension table
-        dim[f'{name}_id'] = range(1, len(dim) + 1)
-
-        self.dimension_table = dim
+        # Optional KeyRegistry keeping surrogate ids stable between runs
+        self.registry = None
+        self.loaded_id = None
+        self.index = None
+        self.business_key = None
+        # Ids of rows changed in place since the last append, and the columns that change
+        self.changed = set()
+        self.changed_columns = []
+
+    def dimension_generator(self, name:str, columns:list, source=None, business_key=None):
         self.name = name
         self.columns = columns
-        
+        # Slowly changing dimension (Type 2): rows sharing the business key are versions of
+        # one member, a new combination of the other columns adds a version taking effect at
+        # the first source date carrying it, which closes the version before. Versions carry Attribute_Hash, Effective_From, Effective_To and Is_Current.
+        self.business_key = business_key
+        if business_key:
+            self.changed_columns = ['Effective_From', 'Effective_To', 'Is_Current']
+        if source is not None:
+            self.update(source)
+
+    @property
+    def registered_columns(self):
+        # Columns kept in the key registry
+        return [*self.columns, f'{self.name}_id'] + (['Effective_From'] if self.business_key else [])
+
+    def reseed(self, registry):
+        # After a full load the registry holds the ids just uploaded, so a later incremental
+        # run continues from the warehouse instead of from the keys of an older run
+        registry.replace(f'{self.name}_dim', self.dimension_table.sort_values(f'{self.name}_id')[self.registered_columns])
+
+    @property
+    def attributes(self):
+        return [column for column in self.columns if column not in self.business_key]
+
+    def restore(self):
+        if self.dimension_table is None and self.registry is not None:
+            # Start from the keys handed out by earlier runs
+            self.dimension_table = self.registry.get_keys(f'{self.name}_dim')
+            if self.business_key and self.dimension_table is not None:
+                self.dimension_table = self.history(self.dimension_table)
+
+    def history(self, versions):
+        # Validity columns of registered versions, which are stored with their Effective_From only
+        versions = versions.copy()
+        versions['Effective_From'] = pd.to_datetime(versions['Effective_From']).astype('datetime64[ns]')
+        versions['Attribute_Hash'] = row_hash(versions, self.attributes)
+        return self.timeline(versions)
+
+    def timeline(self, versions):
+        # Versions of a member follow each other in Effective_From order, whatever order the
+        # batches came in: each is closed when the next takes effect and the latest is current
+        id_column = f'{self.name}_id'
+        versions = versions.sort_values(['Effective_From', id_column], kind='stable', ignore_index=True)
+        members = versions.groupby(self.business_key, sort=False, observed=True)
+        versions['Effective_To'] = members['Effective_From'].shift(-1)
+        versions['Is_Current'] = (members.cumcount(ascending=False) == 0).to_numpy()
+        versions = versions.sort_values(id_column, ignore_index=True)
+        return versions[[*self.columns, id_column, 'Attribute_Hash', 'Effective_From', 'Effective_To', 'Is_Current']]
+
+    def update(self, source):
+        self.restore()
+
+        # Add the natural keys of a batch that earlier batches have not seen yet
+        start = 0
+        moved = False
+        if self.business_key:
+            # One version per combination of attributes, taking effect at the first source
+            # date carrying it; versions are compared on the business key and a hash of the
+            # other attributes
+            dim = source.groupby(self.columns, sort=False, observed=True, dropna=False)['date'].min().reset_index()
+            dim = dim.rename(columns={'date': 'Effective_From'}).sort_values('Effective_From', kind='stable')
+            dim['Effective_From'] = dim['Effective_From'].astype('datetime64[ns]')
+            dim['Attribute_Hash'] = row_hash(dim, self.attributes)
+        else:
+            dim = source[self.columns].drop_duplicates()
+        if self.dimension_table is not None:
+            if self.business_key:
+                dim, moved = self.new_versions(dim)
+            else:
+                seen = dim.merge(self.dimension_table[self.columns], on=self.columns, how='left', indicator=True)
+                dim = dim[(seen['_merge'] == 'left_only').values]
+            start = int(self.dimension_table[f'{self.name}_id'].max())
+        dim = dim.copy()
+        # Creating primary key for dimension table, continuing from the previous batch
+        dim[f'{self.name}_id'] = range(start + 1, start + len(dim) + 1)
+        if self.business_key:
+            dim = self.expire(dim)
+
+        if self.dimension_table is None:
+            self.dimension_table = dim
+        elif len(dim):
+            # The table is only replaced when rows were added, the transform pool restarts on a new table
+            self.dimension_table = pd.concat([self.dimension_table, dim])
+            self.index = None
+        if self.registry is not None and moved:
+            # Registered start dates changed, the registry is rewritten with the new versions
+            self.reseed(self.registry)
+        elif self.registry is not None and len(dim):
+            self.registry.register(f'{self.name}_dim', dim[self.registered_columns])
+
+    def new_versions(self, dim):
+        # A combination is new unless it is the version of its member in effect at its date,
+        # so a member reverting to earlier attributes gets a new version while rows of an
+        # earlier version arriving in a later batch do not. Rows dated before the first
+        # version of a member with the same attributes move its Effective_From back.
+        id_column = f'{self.name}_id'
+        table = self.dimension_table
+        versions = table[[*self.business_key, 'Effective_From', id_column]].astype(dim[self.business_key].dtypes.to_dict())
+        versions = versions.astype({'Effective_From': 'datetime64[ns]'}).sort_values('Effective_From', kind='stable')
+        dates = dim[[*self.business_key, 'Effective_From']]
+        before = pd.merge_asof(dates, versions, on='Effective_From', by=self.business_key, direction='backward')[id_column]
+        after = pd.merge_asof(dates, versions, on='Effective_From', by=self.business_key, direction='forward')[id_column]
+        in_effect = before.fillna(after)
+        known = in_effect.notna().to_numpy()
+        hashes = table.set_index(id_column)['Attribute_Hash']
+        seen = np.zeros(len(dim), dtype=bool)
+        seen[known] = hashes.loc[in_effect[known].astype('int64')].to_numpy() == dim['Attribute_Hash'].to_numpy()[known]
+        earlier = seen & before.isna().to_numpy()
+        if earlier.any():
+            ids = after[earlier].astype('int64').to_numpy()
+            table = table.copy()
+            rows = table[id_column].isin(ids).to_numpy()
+            table.loc[rows, 'Effective_From'] = table.loc[rows, id_column].map(pd.Series(dim['Effective_From'].to_numpy()[earlier], index=ids)).to_numpy()
+            self.changed.update(ids.tolist())
+            self.dimension_table = table
+        return dim[~seen], bool(earlier.any())
+
+    def expire(self, dim):
+        # New versions are placed in the timeline of their member; loaded versions whose
+        # Effective_To or Is_Current change are updated in place on the next append
+        id_column = f'{self.name}_id'
+        columns = [*self.columns, id_column, 'Attribute_Hash', 'Effective_From']
+        table = self.dimension_table
+        if table is None or not len(dim):
+            return self.timeline(dim[columns])
+        touched = pd.MultiIndex.from_frame(table[self.business_key]).isin(pd.MultiIndex.from_frame(dim[self.business_key]))
+        versions = self.timeline(pd.concat([table.loc[touched, columns], dim[columns]], ignore_index=True))
+        new = versions[id_column].isin(dim[id_column]).to_numpy()
+        loaded = versions[~new].set_index(id_column).loc[table.loc[touched, id_column]]
+        effective_to = loaded['Effective_To'].to_numpy()
+        is_current = loaded['Is_Current'].to_numpy(dtype=bool)
+        previous_to = pd.to_datetime(table.loc[touched, 'Effective_To']).astype('datetime64[ns]').to_numpy()
+        changed = (is_current != table.loc[touched, 'Is_Current'].to_numpy(dtype=bool)) | ~((effective_to == previous_to) | (pd.isna(effective_to) & pd.isna(previous_to)))
+        if changed.any():
+            table = table.copy()
+            table.loc[touched, 'Effective_To'] = effective_to
+            table.loc[touched, 'Is_Current'] = is_current
+            self.changed.update(table.loc[touched, id_column].to_numpy()[changed].tolist())
+            self.dimension_table = table
+        return versions[new].reset_index(drop=True)
+
+    def build_index(self):
+        # Hash index over the natural key columns, positions line up with the id array
+        table = self.dimension_table
+        if self.business_key:
+            # Versions are in id order; when a member went back to earlier attributes,
+            # facts with them resolve to the newest version
+            table = table.drop_duplicates(self.columns, keep='last')
+        keys = table[self.columns]
+        if len(self.columns) == 1:
+            index = pd.Index(keys[self.columns[0]])
+        else:
+            index = pd.MultiIndex.from_frame(keys)
+        self.index = KeyIndex(self.name, self.columns, index, table[f'{self.name}_id'].to_numpy())
+
+    def key_index(self):
+        # Read-only index of the current rows, shared with transform worker processes
+        if self.index is None:
+            self.build_index()
+        return self.index
+
+    def positions(self, source):
+        # Row of the key index matching every source row, which is the dimension table row
+        # except for versioned dimensions
+        return self.key_index().positions(source)
+
+    def lookup(self, source, positions=None):
+        # Return the foreign key of every source row
+        return self.key_index().lookup(source, positions)
+
     def load(self):
         if self.dimension_table is not None:
             # Upload dimension table to data warehouse
             database.upload_dataframe_sqldatabase(f'{self.name}_dim', blob_data=self.dimension_table)
-        
+
             # Saving dimension table as separate file
-            self.dimension_table.to_csv(f'./data/{self.name}_dim.csv')
+            write_snapshot(f'{self.name}_dim', self.dimension_table)
         else:
-            print("Please create a dimension table first using dimension_generator") 
-        
+            print("Please create a dimension table first using dimension_generator")
+
+    def append(self):
+        # Upload only the rows the warehouse does not have yet, leaving existing ids untouched
+        if self.dimension_table is None:
+            print("Please create a dimension table first using dimension_generator")
+            return
+        table_name = f'{self.name}_dim'
+        if self.loaded_id is None:
+            if not database.table_exists(table_name):
+                self.load()
+                self.loaded_id = int(self.dimension_table[f'{self.name}_id'].max())
+                self.changed = set()
+                return
+            self.loaded_id = database.get_max_id(table_name, f'{self.name}_id')
+        new_rows = self.dimension_table[self.dimension_table[f'{self.name}_id'] > self.loaded_id]
+        if len(new_rows):
+            database.append_dataframe_sqldatabase(table_name, blob_data=new_rows)
+            self.loaded_id = int(new_rows[f'{self.name}_id'].max())
+        self.apply_changes()
+        write_snapshot(f'{self.name}_dim', self.dimension_table)
+
+    def apply_changes(self):
+        # Update the rows changed since the last append in place through a staging table,
+        # e.g. versions closed by a newer one
+        if not self.changed:
+            return
+        table_name = f'{self.name}_dim'
+        id_column = f'{self.name}_id'
+        changed = self.dimension_table.loc[self.dimension_table[id_column].isin(self.changed), [id_column, *self.changed_columns]]
+        database.upload_dataframe_sqldatabase(f'{table_name}_Stage', blob_data=changed, primary_key=False)
+        database.merge_sqldatabase(table_name, id_column, list(changed.columns), stage_name=f'{table_name}_Stage', insert=False)
+        database.delete_sqldatabase(f'{table_name}_Stage')
+        self.changed = set()
+
 class DimStaff(ModelAbstract):
-    def __init__(self):
+    def __init__(self, source=None):
         super().__init__()
-        self.dimension_generator('Staff', ['Natural Key Staff ID', 'Name', 'Contact Phone', 'Home Address', "Email"])
-            
+        self.dimension_generator('Staff', ['Natural Key Staff ID', 'Name', 'Contact Phone', 'Home Address', "Email"], source, business_key=['Natural Key Staff ID'])
+
 class DimDate(ModelAbstract):
-    def __init__(self):
+    # Generated calendar with one row per day keyed by the integer yyyymmdd date, so
+    # the key of a fact is computed from its date instead of looked up
+    def __init__(self, source=None, start=calendar_start, end=calendar_end):
         super().__init__()
-        self.dimension_generator('Date', ['date'])
-        
+        self.start = pd.Timestamp(start)
+        self.end = pd.Timestamp(end)
+        self.loaded_range = None
+        self.changed_columns = ['isholiday']
+        self.dimension_generator('Date', ['date'], source)
+
+    def restore(self):
+        # Keys do not depend on earlier runs, the calendar is read from its cached artifact
+        if self.dimension_table is None:
+            self.dimension_table = load_calendar(self.start, self.end)
+
+    def key_index(self):
+        # Kept until the calendar start moves, so the transform pool keeps its workers
+        if self.index is None or self.index.start != self.start:
+            self.index = CalendarIndex(self.start)
+        return self.index
+
+    def reseed(self, registry):
+        # Calendar keys are computed from the date, nothing is registered
+        pass
+
+    def day_positions(self, dates):
+        # Row of every date in the calendar
+        return self.key_index().day_positions(dates)
+
+    def update(self, source):
+        self.restore()
+        dates = source['date']
+        if len(dates) and (dates.min() < self.start or dates.max() > self.end):
+            # Widen the calendar to whole years around the source dates, keeping the holiday flags
+            previous = self.dimension_table
+            self.start = min(self.start, pd.Timestamp(year=dates.min().year, month=1, day=1))
+            self.end = max(self.end, pd.Timestamp(year=dates.max().year, month=12, day=31))
+            self.dimension_table = None
+            self.restore()
+            self.dimension_table = self.dimension_table.copy()
+            self.dimension_table.iloc[self.day_positions(previous['Full_Date']), self.dimension_table.columns.get_loc('isholiday')] = previous['isholiday'].to_numpy()
+
+        # Days the source marks as holidays, as flagged in Holiday_dim
+        positions = np.unique(self.positions(source[(source['isholiday'] == 'yes').to_numpy()]))
+        positions = positions[(self.dimension_table['isholiday'].to_numpy()[positions] != 'yes')]
+        if len(positions):
+            self.dimension_table = self.dimension_table.copy()
+            self.dimension_table.iloc[positions, self.dimension_table.columns.get_loc('isholiday')] = 'yes'
+            self.changed.update(self.dimension_table['Date_id'].to_numpy()[positions].tolist())
+
+    def append(self):
+        # Upload the days outside the range already loaded, then update changed holiday flags
+        table_name = f'{self.name}_dim'
+        ids = self.dimension_table['Date_id']
+        if self.loaded_range is None:
+            if not database.table_exists(table_name):
+                self.load()
+                self.loaded_range = (int(ids.min()), int(ids.max()))
+                self.changed = set()
+                return
+            loaded = database.get_sql_table('SELECT MIN([Date_id]) AS [first], MAX([Date_id]) AS [last] FROM [dbo].[Date_dim]')[0]
+            self.loaded_range = (int(loaded['first']), int(loaded['last']))
+        first, last = self.loaded_range
+        new_rows = self.dimension_table[(ids < first) | (ids > last)]
+        if len(new_rows):
+            database.append_dataframe_sqldatabase(table_name, blob_data=new_rows)
+            self.loaded_range = (min(first, int(ids.min())), max(last, int(ids.max())))
+        self.apply_changes()
+        write_snapshot(f'{self.name}_dim', self.dimension_table)
+
 class DimDepartment(ModelAbstract):
-    def __init__(self):
+    def __init__(self, source=None):
         super().__init__()
-        self.dimension_generator('Department', ['Department'])
+        self.dimension_generator('Department', ['Department'], source)
 
 class DimMaintenanceJob(ModelAbstract):
-    def __init__(self):
+    def __init__(self, source=None):
         super().__init__()
-        self.dimension_generator('MaintenanceJob', ['work type'])
-        
+        self.dimension_generator('MaintenanceJob', ['work type'], source)
+
 class DimTravelAllowancePolicy(ModelAbstract):
-    def __init__(self):
+    def __init__(self, source=None):
         super().__init__()
-        self.dimension_generator('TravelAllowancePolicy', ['vehicle type', 'travelallowanceRate'])
-        
+        self.dimension_generator('TravelAllowancePolicy', ['vehicle type', 'travelallowanceRate'], source)
+
 
 class DimWeatherAllowancePolicy(ModelAbstract):
-    def __init__(self):
+    def __init__(self, source=None):
+        super().__init__()
+        self.dimension_generator('WeatherAllowancePolicy', ['weather', 'temperature', 'weatehr allowance'], source)
+
+class DimHoliday(ModelAbstract):
+    def __init__(self, source=None):
         super().__init__()
-        self.dimension_generator('WeatherAllowancePolicy', ['weather', 'temperature', 'weatehr allowance'])
-    
-        
-        
+        self.dimension_generator('Holiday', ['isholiday'], source)
+
+
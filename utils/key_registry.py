@@ -0,0 +1,33 @@
+import os, sqlite3
+from contextlib import closing
+import pandas as pd
+
+# Local SQLite file holding every surrogate key handed out so far
+registry_path = os.environ.get('KEY_REGISTRY_PATH', './data/key_registry.db')
+
+class KeyRegistry():
+    # Persistent surrogate key registry: one table per dimension with the
+    # natural key columns and the id assigned the first time they were seen
+    def __init__(self, path = registry_path):
+        self.path = path
+
+    def get_keys(self, table_name):
+        # Return all registered keys of a dimension, or None if it has none yet
+        with closing(sqlite3.connect(self.path)) as con:
+            exists = con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table_name,)).fetchone()
+            if exists is None:
+                return None
+            keys = pd.read_sql_query(f'SELECT * FROM "{table_name}" ORDER BY rowid', con)
+        return keys if len(keys) else None
+
+    def register(self, table_name, keys):
+        # Store newly assigned keys so later runs hand out the same ids
+        with closing(sqlite3.connect(self.path)) as con:
+            keys.to_sql(table_name, con, if_exists='append', index=False)
+            con.commit()
+
+    def replace(self, table_name, keys):
+        # Make the registered keys exactly the ones a full load uploaded, in id order
+        with closing(sqlite3.connect(self.path)) as con:
+            keys.to_sql(table_name, con, if_exists='replace', index=False)
+            con.commit()
@@ -0,0 +1,120 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+import numpy as np
+import pandas as pd
+from utils.calendar_dim import date_keys
+
+# Policy dimensions read by the allowance rules, in the order AllowanceRules.apply takes them
+POLICY_DIMENSIONS = ['TravelAllowancePolicy', 'WeatherAllowancePolicy', 'Holiday']
+
+class KeyIndex():
+    # Read-only hash index of a dimension: natural key -> row position -> surrogate id.
+    # It holds no reference to the dimension object, so worker processes can share it
+    # without importing the dimension classes or their warehouse connection.
+    def __init__(self, name, columns, index, ids):
+        self.name = name
+        self.columns = columns
+        self.index = index
+        self.ids = ids
+
+    def positions(self, source):
+        # Row of the dimension table matching every source row, with one vectorized hash lookup
+        if len(self.columns) == 1:
+            keys = source[self.columns[0]]
+        else:
+            keys = pd.MultiIndex.from_frame(source[self.columns])
+        positions = self.index.get_indexer(keys)
+        if (positions < 0).any():
+            raise KeyError(f'{(positions < 0).sum()} rows have no matching key in {self.name}_dim')
+        return positions
+
+    def lookup(self, source, positions=None):
+        # Foreign key of every source row
+        if positions is None:
+            positions = self.positions(source)
+        return self.ids[positions]
+
+class CalendarIndex():
+    # Calendar rows are one per day from start, so positions and keys are computed from the date
+    def __init__(self, start):
+        self.start = pd.Timestamp(start)
+
+    def day_positions(self, dates):
+        # Row of every date in the calendar
+        return ((dates.dt.normalize() - self.start) // pd.Timedelta(days=1)).to_numpy()
+
+    def positions(self, source):
+        return self.day_positions(source['date'])
+
+    def lookup(self, source, positions=None):
+        return date_keys(source['date'])
+
+def pay_sums(fact_table, measures):
+    # Pay sums per staff and date; narrow integer measures are widened first so sums cannot overflow
+    frame = fact_table[['Staff_id', 'Date_id', *measures]]
+    frame = frame.astype({column: 'int64' for column in measures if pd.api.types.is_integer_dtype(frame[column])})
+    return frame.groupby(['Staff_id', 'Date_id'], as_index=False)[list(measures)].sum()
+
+def transform_keys(fact_table, indexes, policies, rules, drop_columns, measures, stage=None):
+    # Allowances, foreign keys and pay sums of a batch whose keys are all in the dimension
+    # indexes. stage is an optional profiler.stage to time every phase with.
+    stage = stage or (lambda name, rows=None: nullcontext())
+    rows = len(fact_table)
+    with stage('transform/positions', rows=rows):
+        positions = {name: index.positions(fact_table) for name, index in indexes.items()}
+
+    # Travel, weather and work payment from the policy dimensions
+    with stage('transform/allowances', rows=rows):
+        rules.apply(fact_table, *[(policies[name], positions[name]) for name in POLICY_DIMENSIONS])
+
+    # Replace columns in fact table with respective foreign keys
+    with stage('transform/foreign_keys', rows=rows):
+        for name, index in indexes.items():
+            fact_table[f'{name}_id'] = index.lookup(fact_table, positions[name]).astype('int32')
+        fact_table.drop(columns=drop_columns, inplace=True)
+
+    with stage('transform/summarize', rows=rows):
+        sums = pay_sums(fact_table, measures)
+    return fact_table, sums
+
+def partition_rows(frame, column, partitions):
+    # Partition number of every row; all rows with the same value of column share a partition
+    hashes = pd.util.hash_pandas_object(frame[column], index=False).to_numpy()
+    return (hashes % np.uint64(partitions)).astype('int64')
+
+# Dimension indexes and rules of the current pool, set once per worker process
+_shared = None
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+
+def _transform_partition(frame):
+    return transform_keys(frame, **_shared)
+
+def transform_pool(workers, shared):
+    # Process pool whose workers receive the dimension indexes once through the initializer
+    # (inherited without a copy where processes are forked) instead of with every partition
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(shared,))
+
+def same_shared(shared, other):
+    # True when other holds the same dimension indexes and policy tables. They are compared
+    # by identity, dimensions replace them instead of modifying them in place.
+    return other is not None and all(
+        shared[key].keys() == other[key].keys() and all(shared[key][name] is other[key][name] for name in shared[key])
+        for key in ('indexes', 'policies'))
+
+def transform_partitions(fact_table, column, pool, workers):
+    # Run transform_keys on partitions of the batch in a pool from transform_pool and
+    # reassemble the result in the original row order, so it equals the single process result
+    codes = partition_rows(fact_table, column, workers)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.cumsum(np.bincount(codes, minlength=workers))
+    parts = [fact_table.iloc[rows] for rows in np.split(order, bounds[:-1]) if len(rows)]
+    results = list(pool.map(_transform_partition, parts))
+    fact_table = pd.concat([frame for frame, _ in results])
+    fact_table = fact_table.iloc[np.argsort(order, kind='stable')]
+    # Partitions share no staff member when split by staff, the regroup only merges other splits
+    sums = pd.concat([sums for _, sums in results], ignore_index=True)
+    sums = sums.groupby(['Staff_id', 'Date_id'], as_index=False).sum()
+    return fact_table, sums
@@ -0,0 +1,111 @@
+import os, sys, json, time, threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is reported as null there
+    resource = None
+
+# Optional path prefix for the profile of a run, written as <prefix>.json and <prefix>.prom
+profile_path = os.environ.get('ETL_PROFILE_PATH')
+
+def peak_rss():
+    # Peak resident set size of the process so far, in bytes
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def frame_memory(frame):
+    return int(frame.memory_usage(deep=True).sum())
+
+class Profiler():
+    # Wall time, rows, peak RSS and DataFrame memory of named pipeline stages.
+    # Stage names are paths such as 'load/Staff_dim/insert'; stages that run
+    # more than once (one per batch) are added up per name.
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, rows=None, frame=None):
+        # The yielded dict takes 'rows' and 'frame' known only at the end of the stage
+        info = {'rows': rows, 'frame': frame}
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            self.record(name, time.perf_counter() - start, info['rows'], info['frame'])
+
+    def record(self, name, seconds, rows=None, frame=None):
+        if rows is None and frame is not None:
+            rows = len(frame)
+        record = {
+            'stage': name,
+            'seconds': seconds,
+            'rows': rows,
+            'peak_rss_bytes': peak_rss(),
+            'frame_bytes': None if frame is None else frame_memory(frame),
+        }
+        with self.lock:
+            self.records.append(record)
+
+    def summary(self):
+        # One entry per stage name, in the order the stages first finished
+        stages = {}
+        with self.lock:
+            records = list(self.records)
+        for record in records:
+            stage = stages.setdefault(record['stage'], {'calls': 0, 'seconds': 0.0, 'rows': None, 'peak_rss_bytes': None, 'frame_bytes': None})
+            stage['calls'] += 1
+            stage['seconds'] += record['seconds']
+            if record['rows'] is not None:
+                stage['rows'] = (stage['rows'] or 0) + record['rows']
+            for key in ['peak_rss_bytes', 'frame_bytes']:
+                if record[key] is not None:
+                    stage[key] = max(stage[key] or 0, record[key])
+        for stage in stages.values():
+            stage['rows_per_sec'] = stage['rows'] / stage['seconds'] if stage['rows'] and stage['seconds'] else None
+        return stages
+
+    def to_json(self):
+        return json.dumps({'stages': self.summary(), 'peak_rss_bytes': peak_rss()}, indent=2)
+
+    def to_prometheus(self):
+        # Prometheus text exposition format, one gauge per measure labelled by stage
+        metrics = [
+            ('etl_stage_seconds', 'seconds', 'Wall time spent in the stage'),
+            ('etl_stage_calls', 'calls', 'Number of times the stage ran'),
+            ('etl_stage_rows', 'rows', 'Rows processed by the stage'),
+            ('etl_stage_rows_per_second', 'rows_per_sec', 'Rows processed per second of wall time'),
+            ('etl_stage_peak_rss_bytes', 'peak_rss_bytes', 'Peak resident set size of the process at the end of the stage'),
+            ('etl_stage_frame_bytes', 'frame_bytes', 'Largest DataFrame handled by the stage'),
+        ]
+        stages = self.summary()
+        lines = []
+        for metric, key, help_text in metrics:
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} gauge')
+            for name, stage in stages.items():
+                if stage[key] is not None:
+                    label = name.replace('\\', '\\\\').replace('"', '\\"')
+                    lines.append(f'{metric}{{stage="{label}"}} {stage[key]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path=profile_path):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(f'{path}.json', 'w') as file:
+            file.write(self.to_json())
+        with open(f'{path}.prom', 'w') as file:
+            file.write(self.to_prometheus())
+        print(f'Profile written to {path}.json and {path}.prom')
+
+    def clear(self):
+        with self.lock:
+            self.records = []
+
+# Shared by the ETL modules so one run ends up in one profile
+profiler = Profiler()
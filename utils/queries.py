@@ -0,0 +1,71 @@
+# Dashboard queries. Each endpoint reads every measure it needs in one scan of
+# the fact table; split_records turns the rows into the existing response shape.
+
+EMPLOYEE_PAY = '''
+    SELECT date, SUM([work payment]) as Hourly_Pay, SUM([travel allowance amount]) as Travel_Pay, SUM([weather allowance amount]) as Weather_Pay, SUM([total pay this job]) as Total_Pay, SUM([work hours]) as Total_Hours
+    FROM [dbo].[Total_Pay_Fact]
+    JOIN [dbo].[Date_dim] ON [dbo].[Total_Pay_Fact].Date_id = [dbo].[Date_dim].Date_id
+    WHERE [dbo].[Total_Pay_Fact].Staff_id = :staff_id
+    GROUP BY date
+'''
+EMPLOYEE_GROUPS = [
+    ['date', 'Hourly_Pay', 'Travel_Pay', 'Weather_Pay', 'Total_Pay'],
+    ['date', 'Total_Hours'],
+]
+
+# Same results read from the summary tables MainETL.load materializes
+EMPLOYEE_PAY_SUMMARY = '''
+    SELECT date, SUM(Hourly_Pay) as Hourly_Pay, SUM(Travel_Pay) as Travel_Pay, SUM(Weather_Pay) as Weather_Pay, SUM(Total_Pay) as Total_Pay, SUM(Total_Hours) as Total_Hours
+    FROM [dbo].[Staff_Month_Pay_Agg]
+    WHERE Staff_id = :staff_id
+    GROUP BY date
+'''
+
+MANAGER_PAY = '''
+    SELECT Name, SUM([work payment]) as Hourly_Pay, SUM([travel allowance amount]) as Travel_Pay, SUM([weather allowance amount]) as Weather_Pay, SUM([total pay this job]) as Total_Pay
+    FROM [dbo].[Total_Pay_Fact]
+    JOIN [dbo].[Staff_dim] ON [dbo].[Total_Pay_Fact].Staff_id = [dbo].[Staff_dim].Staff_id
+    GROUP BY Name
+'''
+MANAGER_PAY_SUMMARY = '''
+    SELECT Name, SUM(Hourly_Pay) as Hourly_Pay, SUM(Travel_Pay) as Travel_Pay, SUM(Weather_Pay) as Weather_Pay, SUM(Total_Pay) as Total_Pay
+    FROM [dbo].[Staff_Pay_Agg]
+    GROUP BY Name
+'''
+MANAGER_GROUPS = [
+    ['Name', 'Hourly_Pay', 'Travel_Pay', 'Weather_Pay'],
+    ['Name', 'Total_Pay'],
+]
+
+def split_records(records, groups):
+    # One list of records per column group, in the order of groups
+    return [[{column: row[column] for column in columns} for row in records] for columns in groups]
+
+# Pages of rows for the streamed record endpoints. Pages are keyset paginated: each
+# page continues after the :cursor key, which is the key of the last row of the previous
+# page, so a page costs the same whatever its depth. Dates are yyyymmdd Date_id bounds,
+# which the fact table index on Date_id serves.
+EMPLOYEE_PAY_ROWS = '''
+    SELECT Date_id, SUM([work payment]) as Hourly_Pay, SUM([travel allowance amount]) as Travel_Pay, SUM([weather allowance amount]) as Weather_Pay, SUM([total pay this job]) as Total_Pay, SUM([work hours]) as Total_Hours
+    FROM [dbo].[Total_Pay_Fact]
+    WHERE Staff_id = :staff_id AND Date_id > :cursor AND Date_id BETWEEN :start AND :end
+    GROUP BY Date_id
+    ORDER BY Date_id
+    OFFSET 0 ROWS FETCH NEXT :limit ROWS ONLY
+'''
+
+def manager_pay_rows(department=False):
+    # One row per staff member under their current name, every version of the member
+    # counts; with department only the jobs done for :department
+    department_filter = 'AND [dbo].[Department_dim].Department = :department' if department else ''
+    return f'''
+    SELECT [dbo].[Staff_dim].[Natural Key Staff ID] as Staff_Key, MAX([Current].Name) as Name, SUM([work payment]) as Hourly_Pay, SUM([travel allowance amount]) as Travel_Pay, SUM([weather allowance amount]) as Weather_Pay, SUM([total pay this job]) as Total_Pay
+    FROM [dbo].[Total_Pay_Fact]
+    JOIN [dbo].[Staff_dim] ON [dbo].[Total_Pay_Fact].Staff_id = [dbo].[Staff_dim].Staff_id
+    JOIN [dbo].[Staff_dim] AS [Current] ON [Current].[Natural Key Staff ID] = [dbo].[Staff_dim].[Natural Key Staff ID] AND [Current].Is_Current = 1
+    JOIN [dbo].[Department_dim] ON [dbo].[Total_Pay_Fact].Department_id = [dbo].[Department_dim].Department_id
+    WHERE [dbo].[Staff_dim].[Natural Key Staff ID] > :cursor AND [dbo].[Total_Pay_Fact].Date_id BETWEEN :start AND :end {department_filter}
+    GROUP BY [dbo].[Staff_dim].[Natural Key Staff ID]
+    ORDER BY [dbo].[Staff_dim].[Natural Key Staff ID]
+    OFFSET 0 ROWS FETCH NEXT :limit ROWS ONLY
+'''
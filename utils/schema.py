@@ -0,0 +1,61 @@
+import pandas as pd
+
+# Declared types of ETL_Example_Data.csv, applied by read_csv while parsing.
+# Repeating text columns are categories, counts and amounts use the narrowest
+# integer type that safely holds them and rates stay float64 for exact pay sums.
+SOURCE_DTYPES = {
+    'Natural Key Staff ID': 'int32',
+    'Name': 'category',
+    'Contact Phone': 'category',
+    'Home Address': 'category',
+    'Email': 'category',
+    'Department': 'category',
+    'work hours': 'int16',
+    'work type': 'category',
+    'travel distance': 'int16',
+    'vehicle type': 'category',
+    'weather': 'category',
+    'temperature': 'category',
+    'isholiday': 'category',
+    'job hourly': 'int32',
+    'work payment $': 'int32',
+    'travelallowanceRate': 'float64',
+    'weatehr allowance': 'int32',
+}
+
+SOURCE_DATE_COLUMNS = ['date']
+SOURCE_DATE_FORMAT = '%d/%m/%Y'
+
+# Keyword arguments for pd.read_csv
+SOURCE_SCHEMA = {
+    'dtype': SOURCE_DTYPES,
+    'parse_dates': SOURCE_DATE_COLUMNS,
+    'date_format': SOURCE_DATE_FORMAT,
+}
+
+# Source columns identifying one fact for change data capture, repeats of the
+# same key within a load are told apart by their order
+SOURCE_KEY_COLUMNS = ['Natural Key Staff ID', 'date', 'work type']
+
+def row_hash(frame, columns=None):
+    # Signed 64 bit hash of every row, fits a BIGINT column
+    frame = frame if columns is None else frame[columns]
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy().view('int64')
+
+def apply_schema(frame):
+    # Cast a frame that was not parsed with SOURCE_SCHEMA, columns already typed are left alone
+    for column in SOURCE_DATE_COLUMNS:
+        if not pd.api.types.is_datetime64_any_dtype(frame[column]):
+            frame[column] = pd.to_datetime(frame[column], format=SOURCE_DATE_FORMAT)
+    changed = {column: dtype for column, dtype in SOURCE_DTYPES.items()
+               if column in frame.columns and str(frame[column].dtype) != dtype}
+    if changed:
+        frame = frame.astype(changed)
+    return frame
+
+def memory_usage(frame):
+    # Bytes held by a frame, including the strings behind object columns
+    return int(frame.memory_usage(deep=True).sum())
+
+def format_bytes(size):
+    return f'{size / 1e6:.2f} MB'
@@ -0,0 +1,139 @@
+import os, mmap
+from abc import ABC, abstractmethod
+
+class StorageAdapter(ABC):
+    # Blob store used by AzureDB. Blobs live in containers and are read as an
+    # iterator of byte chunks, so callers never need a whole blob in memory.
+    def access_container(self, container_name):
+        self.container_name = container_name
+
+    @abstractmethod
+    def delete_container(self):
+        pass
+
+    @abstractmethod
+    def list_blobs(self, prefix=None):
+        pass
+
+    @abstractmethod
+    def chunks(self, blob_name):
+        pass
+
+    @abstractmethod
+    def upload_blob(self, blob_name, data):
+        pass
+
+    @abstractmethod
+    def download_blob(self, blob_name, file_path):
+        pass
+
+    @abstractmethod
+    def delete_blob(self, blob_name, container_name=None):
+        pass
+
+class AzureStorage(StorageAdapter):
+    # Azure Blob Storage, get_client returns the shared BlobServiceClient
+    def __init__(self, get_client):
+        self.get_client = get_client
+        self.container_name = None
+        self._container_client = None
+
+    def access_container(self, container_name):
+        # The container is only contacted the first time container_client is used
+        self.container_name = container_name
+        self._container_client = None
+
+    @property
+    def container_client(self):
+        if self._container_client is None:
+            try:
+                # Creating container if not exist
+                self._container_client = self.get_client().create_container(self.container_name)
+                print(f"Creating container {self.container_name} since not exist in database")
+
+            except Exception as ex:
+                print(f"Acessing container {self.container_name}")
+                # Access the container
+                self._container_client = self.get_client().get_container_client(container=self.container_name)
+        return self._container_client
+
+    def delete_container(self):
+        self.container_client.delete_container()
+
+    def list_blobs(self, prefix=None):
+        return [blob.name for blob in self.container_client.list_blobs(name_starts_with=prefix)]
+
+    def chunks(self, blob_name):
+        # Ranged GETs of max_chunk_get_size bytes each
+        return self.container_client.download_blob(blob_name, max_concurrency=1).chunks()
+
+    def upload_blob(self, blob_name, data):
+        self.container_client.upload_blob(blob_name, data)
+
+    def download_blob(self, blob_name, file_path):
+        with open(file=file_path, mode="wb") as download_file:
+            self.container_client.download_blob(blob_name).readinto(download_file)
+
+    def delete_blob(self, blob_name, container_name=None):
+        blob_client = self.get_client().get_blob_client(container=container_name or self.container_name, blob=blob_name)
+        blob_client.delete_blob()
+
+class LocalStorage(StorageAdapter):
+    # Folder on the local filesystem, one sub folder per container. Blobs are
+    # read through a memory map, so extraction runs without network or extra copies.
+    def __init__(self, root, chunk_size=4 * 1024 * 1024):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.container_name = None
+
+    def path(self, blob_name=''):
+        return os.path.join(self.root, self.container_name, blob_name)
+
+    def delete_container(self):
+        for blob_name in self.list_blobs():
+            os.remove(self.path(blob_name))
+        os.rmdir(self.path())
+
+    def list_blobs(self, prefix=None):
+        folder = self.path()
+        if not os.path.isdir(folder):
+            return []
+        names = []
+        for parent, _, files in os.walk(folder):
+            for file in files:
+                names.append(os.path.relpath(os.path.join(parent, file), folder).replace(os.sep, '/'))
+        if prefix:
+            names = [name for name in names if name.startswith(prefix)]
+        return sorted(names)
+
+    def chunks(self, blob_name):
+        with open(self.path(blob_name), 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for start in range(0, len(mapped), self.chunk_size):
+                    chunk = mapped[start:start + self.chunk_size]
+                    # The chunk is a copy, drop the mapped pages so a large blob does not stay resident
+                    if hasattr(mmap, 'MADV_DONTNEED') and start % mmap.PAGESIZE == 0:
+                        mapped.madvise(mmap.MADV_DONTNEED, start, len(chunk))
+                    yield chunk
+
+    def upload_blob(self, blob_name, data):
+        os.makedirs(os.path.dirname(self.path(blob_name)), exist_ok=True)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with open(self.path(blob_name), 'wb') as file:
+            if isinstance(data, bytes):
+                file.write(data)
+            else:
+                for chunk in iter(lambda: data.read(self.chunk_size), b''):
+                    file.write(chunk)
+
+    def download_blob(self, blob_name, file_path):
+        with open(file=file_path, mode="wb") as download_file:
+            for chunk in self.chunks(blob_name):
+                download_file.write(chunk)
+
+    def delete_blob(self, blob_name, container_name=None):
+        container = container_name or self.container_name
+        os.remove(os.path.join(self.root, container, blob_name))
@@ -0,0 +1,63 @@
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:
+    # Falls back to the standard library encoder, several times slower on large pages
+    orjson = None
+
+# End of stream marker of the Arrow IPC streaming format
+ARROW_EOS = b'\xff\xff\xff\xff\x00\x00\x00\x00'
+
+def encode_value(value):
+    # Values the JSON encoders do not handle themselves, e.g. SUM results from Azure SQL
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=encode_value)
+    return json.dumps(value, default=encode_value, separators=(',', ':')).encode()
+
+async def json_pages(batches, key, limit):
+    # Encode the output of AzureDB.stream_sql_rows_async as {"rows": [...], "next_cursor": key}
+    # one batch at a time. next_cursor is the key of the last row of a full page, or
+    # null on the last page.
+    columns = await batches.__anext__()
+    position = columns.index(key)
+    count = 0
+    last = None
+    yield b'{"rows":['
+    async for rows in batches:
+        chunk = b','.join(dumps(dict(zip(columns, row))) for row in rows)
+        yield chunk if count == 0 else b',' + chunk
+        count += len(rows)
+        last = rows[-1][position]
+    yield b'],"next_cursor":' + dumps(last if count >= limit else None) + b'}'
+
+async def arrow_pages(batches):
+    # Encode the output of AzureDB.stream_sql_rows_async as an Arrow IPC stream, one record
+    # batch per fetched batch. The schema is taken from the first batch; clients page
+    # on with the key of the last row as cursor while a page has limit rows.
+    import pyarrow as pa
+    columns = await batches.__anext__()
+    schema = None
+    async for rows in batches:
+        batch = pa.RecordBatch.from_arrays([pa.array(values) for values in zip(*rows)], names=columns)
+        if schema is None:
+            schema = batch.schema
+            yield schema.serialize().to_pybytes()
+        else:
+            batch = batch.cast(schema)
+        yield batch.serialize().to_pybytes()
+    if schema is None:
+        # No rows, the columns are sent without types
+        yield pa.schema([(column, pa.null()) for column in columns]).serialize().to_pybytes()
+    yield ARROW_EOS